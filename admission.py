@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+import os
+import socket
+import time
+
+# A download on disk may be carved into a tempfile of about the same size,
+# one in memory may be sliced, or written out for the tools that need a path.
+DISK_FACTOR = 2
+MEMORY_FACTOR = 2
+
+DISK_HEADROOM = 1 << 30
+MEMORY_HEADROOM = 1 << 29
+
+ADMISSION_RETRY = 300
+RESERVATION_TTL = 3600
+
+# Sum up the reservations of the other workers, dropping expired ones, and
+# reserve for this one if there is room, all in one step
+ADMIT = """
+local now = tonumber(ARGV[2])
+local reserved_disk, reserved_memory = 0, 0
+local values = redis.call('HGETALL', KEYS[1])
+for i = 1, #values, 2 do
+    if values[i] ~= ARGV[1] then
+        local value = cjson.decode(values[i + 1])
+        if value['expires'] < now then
+            redis.call('HDEL', KEYS[1], values[i])
+        else
+            reserved_disk = reserved_disk + value['disk']
+            reserved_memory = reserved_memory + value['memory']
+        end
+    end
+end
+
+local size = tonumber(ARGV[3])
+local free_disk = tonumber(ARGV[5]) - reserved_disk
+local free_memory = tonumber(ARGV[6])
+if free_memory then
+    free_memory = free_memory - reserved_memory
+end
+
+local mode, disk, memory
+if size <= tonumber(ARGV[4]) and size <= free_disk and
+        (not free_memory or size * tonumber(ARGV[9]) <= free_memory) then
+    mode, disk, memory = 'memory', size, size * tonumber(ARGV[9])
+elseif size * tonumber(ARGV[8]) <= free_disk then
+    mode, disk, memory = 'disk', size * tonumber(ARGV[8]), 0
+else
+    return false
+end
+
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode({
+    disk = disk,
+    memory = memory,
+    expires = now + tonumber(ARGV[7]),
+}))
+return mode
+"""
+
+
+def available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def disk_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize, st.f_blocks * st.f_frsize
+
+
+class Admission(object):
+    # Disk and memory are reserved for every download before it starts.
+    # Reservations are shared by the workers of a host and expire if a
+    # worker dies holding one.
+
+    def __init__(self, redis, key, tmpdir, consumer, spool_threshold,
+                 cache=None):
+        self.redis = redis
+        self.key = '%s:reserved:%s' % (key, socket.gethostname())
+        self.tmpdir = tmpdir
+        self.consumer = consumer
+        self.spool_threshold = spool_threshold
+        # On the same filesystem, and allowed to grow up to its size
+        self.cache = cache
+
+        self.admit_script = redis.register_script(ADMIT)
+
+        self.current = False
+
+    def fits(self, size):
+        # Whether it could ever be downloaded here
+        cache_size = self.cache.maxsize if self.cache else 0
+        return size * DISK_FACTOR + DISK_HEADROOM + cache_size <= disk_space(
+            self.tmpdir)[1]
+
+    def admit(self, size):
+        # Where to download to, 'memory' or 'disk'; None if there is no room
+        # for it right now
+        self.release()
+
+        free_disk = disk_space(self.tmpdir)[0] - DISK_HEADROOM
+        if self.cache:
+            free_disk -= self.cache.growth()
+        free_memory = available_memory()
+        if free_memory is not None:
+            free_memory -= MEMORY_HEADROOM
+
+        mode = self.admit_script(keys=[self.key], args=[
+            self.consumer, time.time(), size, self.spool_threshold,
+            free_disk, '' if free_memory is None else free_memory,
+            RESERVATION_TTL, DISK_FACTOR, MEMORY_FACTOR])
+        if not mode:
+            return None
+
+        self.current = True
+        return mode
+
+    def release(self):
+        if self.current:
+            self.current = False
+            self.redis.hdel(self.key, self.consumer)
@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import pywikibot
+import requests
+from pywikibot.comms import http
+from pywikibot.data.api import APIError
+
+POOL_SIZE = 4
+TIMEOUT = 60
+
+
+class ApiClient(object):
+    # Read queries over pooled keep-alive connections with compressed
+    # responses, several at a time if asked to. Everything that writes still
+    # goes through pywikibot.
+
+    def __init__(self, site, endpoint=None, pool_size=POOL_SIZE,
+                 timeout=TIMEOUT):
+        self.site = site
+        self.endpoint = endpoint or '%s://%s%s' % (
+            site.protocol(), site.hostname(), site.apipath())
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = http.user_agent()
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        # Logged in as pywikibot is
+        self.session.cookies = http.cookie_jar
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.pool = ThreadPool(pool_size)
+
+        self.lock = threading.Lock()
+        self.stats = {
+            'requests': 0,
+            'items': 0,
+            'time': 0.0,
+        }
+
+    def query(self, params, items=1):
+        data = {'format': 'json'}
+        for key, value in params.items():
+            if isinstance(value, (list, tuple, set)):
+                value = '|'.join(value)
+            data[key] = value
+
+        start = time.time()
+        resp = self.session.post(self.endpoint, data=data,
+                                 timeout=(10, self.timeout))
+        resp.raise_for_status()
+        res = resp.json()
+        elapsed = time.time() - start
+
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['items'] += items
+            self.stats['time'] += elapsed
+
+        if 'error' in res:
+            error = dict(res['error'])
+            raise APIError(error.pop('code'), error.pop('info'), **error)
+        return res
+
+    def map(self, func, items):
+        # Independent queries in parallel
+        if len(items) <= 1:
+            return map(func, items)
+        return self.pool.map(func, items)
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+        pywikibot.output(
+            'API: %d requests for %d items, %.0fms per request, %.0fms per '
+            'item' % (stats['requests'], stats['items'],
+                      1000 * stats['time'] / (stats['requests'] or 1),
+                      1000 * stats['time'] / (stats['items'] or 1)))
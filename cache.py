@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import pywikibot
+
+from detection.utils import MemoryFile, private_dir
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'embeddeddata')
+CACHE_SIZE = 1 << 32
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadCache(object):
+    # Downloaded files by SHA-1, shared by the workers of a host. Only files
+    # that matched the SHA-1 from imageinfo are put in, so a hit never needs
+    # the network, though hits are hashed again in case a file got damaged.
+    # The least recently used files go first when the cache is over size;
+    # hits touch the file's mtime. The directory must be ours and private.
+
+    def __init__(self, directory=CACHE_DIR, maxsize=CACHE_SIZE):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+
+        private_dir(directory)
+
+    def mkdtemp(self):
+        # For downloads, on the same filesystem so they can be linked in and
+        # out. Left alone by evict() like the files being written.
+        return tempfile.mkdtemp(prefix='.job-', dir=self.directory)
+
+    def cache_path(self, sha1):
+        return os.path.join(self.directory, sha1)
+
+    def get(self, sha1, path):
+        # Make the cached file available at path, which is ours to remove
+        cached = self.cache_path(sha1)
+        try:
+            try:
+                os.link(cached, path)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.copyfile(cached, path)
+            if file_sha1(path) != sha1:
+                self.discard(sha1)
+                os.remove(path)
+                return False
+            os.utime(cached, None)
+        except (IOError, OSError):
+            # Not there, or evicted just now
+            return False
+        return True
+
+    def read(self, sha1):
+        cached = self.cache_path(sha1)
+        try:
+            with open(cached, 'rb') as f:
+                data = f.read()
+            if hashlib.sha1(data).hexdigest() != sha1:
+                self.discard(sha1)
+                return None
+            os.utime(cached, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def discard(self, sha1):
+        pywikibot.warning('Cached %s does not match its SHA-1' % sha1)
+        try:
+            os.remove(self.cache_path(sha1))
+        except OSError:
+            pass
+
+    def put(self, sha1, f):
+        if self.maxsize <= 0:
+            return
+
+        tmp = os.path.join(self.directory, '.%s' % uuid.uuid1())
+        try:
+            if isinstance(f, MemoryFile):
+                with open(tmp, 'wb') as fout:
+                    fout.write(f.data)
+            else:
+                try:
+                    os.link(f, tmp)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    shutil.copyfile(f, tmp)
+            os.rename(tmp, self.cache_path(sha1))
+        except (IOError, OSError) as e:
+            pywikibot.warning('Cannot cache %s: %s' % (sha1, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+
+        self.evict()
+
+    def entries(self):
+        ret = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                # Being written, or a download directory
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            ret.append((st.st_mtime, st.st_size, name))
+        return ret
+
+    def growth(self):
+        # How much more disk the cache may take
+        return max(self.maxsize - sum(size for mtime, size, name
+                                      in self.entries()), 0)
+
+    def evict(self):
+        with self.lock:
+            entries = self.entries()
+            total = sum(size for mtime, size, name in entries)
+
+            entries.sort()
+            for mtime, size, name in entries:
+                if total <= self.maxsize:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                total -= size
@@ -18,39 +18,123 @@
 from __future__ import absolute_import
 
 import collections
+import threading
+from multiprocessing.pool import ThreadPool
 
-from detection.by_ending import detect as ending_detect
-from detection.by_magic import detect as magic_detect
-from detection.middleware import detect as middleware_detect
+from detection.by_ending import ARCHIVE_TYPES, find_end
+from detection.by_ending import detect_iter as ending_detect
+from detection.by_magic import detect_iter as magic_detect
+from detection.middleware import detect_iter as middleware_detect
 
+# Bump whenever detection finds more than before, so that rescan.py goes over
+# the files checked by older versions again
+VERSION = 1
 
-def detect(f):
+# Magic signatures are looked for from this much before the end of the file's
+# own data, if that is known exactly
+MAGIC_OVERLAP = 1 << 12
+
+ASYNC_POOL_SIZE = 4
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def conclusive(item):
+    # Enough for execute_file to go for deletion
+    return ((item['posexact'] or item['middleware']) and
+            item['mime'][0] in ARCHIVE_TYPES)
+
+
+def magic_iter(f, start, end=None):
+    for item in magic_detect(f, start, end):
+        yield {
+            'pos': item['pos'],
+            'posexact': True,
+            'via': ['Magic'],
+            'mime': item['mime'],
+            'middleware': None
+        }
+
+
+def detect_iter(f, stop=False, thorough=False):
+    # Every finding as soon as it is confirmed. With stop, no more is looked
+    # for after a conclusive one, unless an earlier position could still
+    # turn up: the ending stage goes in file order, so after a conclusive one
+    # there only signatures before it are looked for, but the magic stage
+    # only has them all once it is done. Unless thorough, signatures inside
+    # the file's own data are not looked for.
+    end = find_end(f)
+    minor, pos, posexact = end
+
+    start = 0
+    if posexact and pos is not None and not thorough:
+        start = max(pos - MAGIC_OVERLAP, 0)
+
+    for item in ending_detect(f, end):
+        item = {
+            'pos': item['pos'],
+            'posexact': item['posexact'],
+            'via': ['Ending'],
+            'mime': item['mime'],
+            'middleware': None
+        }
+        yield item
+        if stop and conclusive(item):
+            if start < item['pos']:
+                for earlier in magic_iter(f, start, item['pos']):
+                    yield earlier
+            return
+
+    found = False
+    for item in magic_iter(f, start):
+        yield item
+        found |= conclusive(item)
+    if stop and found:
+        return
+
+    for item in middleware_detect(f):
+        item = {
+            'pos': item['pos'],
+            'posexact': False,
+            'via': item.get('via', []),
+            'mime': item.get('mime', ('?/?', '?')),
+            'middleware': item['middleware']
+        }
+        yield item
+        if stop and conclusive(item):
+            return
+
+
+def detect(f, stop=False, thorough=False):
     ret = collections.defaultdict(lambda: {
         'posexact': False,
         'via': [],
         'mime': ('?/?', '?'),
         'middleware': None
     })
-    for item in ending_detect(f) or []:
+    middlewares = []
+    for item in detect_iter(f, stop, thorough):
+        if item['middleware']:
+            middlewares.append(item)
+            continue
+
         ret[item['pos']]['pos'] = item['pos']
         ret[item['pos']]['posexact'] |= item['posexact']
-        ret[item['pos']]['via'].append('Ending')
-        ret[item['pos']]['mime'] = item['mime']
-    for item in magic_detect(f) or []:
-        ret[item['pos']]['pos'] = item['pos']
-        ret[item['pos']]['posexact'] = True
-        ret[item['pos']]['via'].append('Magic')
+        ret[item['pos']]['via'] += item['via']
         ret[item['pos']]['mime'] = item['mime']
     ret = collections.OrderedDict(
         sorted(ret.items(), key=lambda (k, v): k)).values()
 
-    for item in middleware_detect(f) or []:
-        ret.append({
-            'pos': item['pos'],
-            'posexact': False,
-            'via': item.get('via', []),
-            'mime': item.get('mime', ('?/?', '?')),
-            'middleware': item['middleware']
-        })
+    return ret + middlewares
+
 
-    return ret
+def detect_async(f, callback=None, stop=False, thorough=False):
+    # For callers with many files in flight. Much of detect() is waiting for
+    # external programs, which overlaps well in threads; for CPU-bound
+    # throughput use the daemon's process pool.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(ASYNC_POOL_SIZE)
+    return _pool.apply_async(detect, (f, stop, thorough), callback=callback)
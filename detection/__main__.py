@@ -0,0 +1,200 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+# python -m detection scan [-jobs:N] [-output:results.jsonl [-resume]]
+#                          [-daemon:socket] [-thorough] path...
+# python -m detection daemon [-socket:path] [-pool:N]
+#
+# The daemon listens on ~/.embeddeddata/detect.sock unless told otherwise;
+# its directory is made private, so only the same account can connect, and
+# -daemon: has to name that socket.
+
+from __future__ import absolute_import
+
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+from detection import daemon, detect
+
+REPORT_INTERVAL = 10
+
+
+def walk(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                yield os.path.join(root, name)
+
+
+def scanned_paths(output):
+    # From the results of an earlier run. Failures are tried again, they may
+    # have been temporary.
+    ret = set()
+    try:
+        with open(output) as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # Cut off when that run was killed
+                    continue
+                if item.get('error') is None:
+                    ret.add(item['path'])
+    except IOError:
+        pass
+    return ret
+
+
+# State of each pool process
+_detect = None
+_thorough = False
+
+
+def init_scanner(socket_path, thorough):
+    global _detect, _thorough
+    _detect = daemon.DetectionClient(socket_path) if socket_path else detect
+    _thorough = thorough
+
+
+def scan_file(path):
+    start = time.time()
+    ret = {
+        'path': path,
+        'size': None,
+        'result': None,
+        'error': None,
+    }
+    try:
+        ret['size'] = os.path.getsize(path)
+        ret['result'] = _detect(path, thorough=_thorough)
+    except Exception as e:
+        traceback.print_exc()
+        ret['error'] = '%s: %s' % (type(e).__name__, e)
+    ret['time'] = time.time() - start
+    return ret
+
+
+def report(stats, started, prefix=''):
+    elapsed = (time.time() - started) or 1
+    sys.stderr.write(
+        '%s%d files, %d with data, %d errors; %.1f files/s, %.1f MiB/s\n' % (
+            prefix, stats['files'], stats['hits'], stats['errors'],
+            stats['files'] / elapsed,
+            stats['bytes'] / elapsed / (1 << 20)))
+
+
+def scan(args):
+    jobs = multiprocessing.cpu_count()
+    output = None
+    resume = False
+    socket_path = None
+    thorough = False
+    paths = []
+    for arg in args:
+        if arg.startswith('-jobs:'):
+            jobs = int(arg[len('-jobs:'):])
+        elif arg.startswith('-output:'):
+            output = arg[len('-output:'):]
+        elif arg == '-resume':
+            resume = True
+        elif arg.startswith('-daemon:'):
+            socket_path = arg[len('-daemon:'):]
+        elif arg == '-thorough':
+            # Also look for signatures inside the files' own data
+            thorough = True
+        else:
+            paths.append(arg)
+
+    skip = set()
+    if output is None:
+        out = sys.stdout
+    else:
+        if resume:
+            skip = scanned_paths(output)
+        out = open(output, 'a+' if resume else 'w')
+        if resume and os.path.getsize(output):
+            out.seek(-1, os.SEEK_END)
+            if out.read(1) != '\n':
+                # The last line was cut off
+                out.write('\n')
+
+    stats = {
+        'files': 0,
+        'skipped': 0,
+        'hits': 0,
+        'errors': 0,
+        'bytes': 0,
+    }
+
+    def pending():
+        for path in walk(paths):
+            if path in skip:
+                stats['skipped'] += 1
+            else:
+                yield path
+
+    pool = multiprocessing.Pool(jobs, init_scanner, (socket_path, thorough))
+    started = reported = time.time()
+    try:
+        for res in pool.imap_unordered(scan_file, pending()):
+            out.write(json.dumps(res) + '\n')
+            out.flush()
+
+            stats['files'] += 1
+            stats['bytes'] += res['size'] or 0
+            if res['error']:
+                stats['errors'] += 1
+            elif res['result']:
+                stats['hits'] += 1
+
+            if time.time() - reported > REPORT_INTERVAL:
+                report(stats, started)
+                reported = time.time()
+
+        pool.close()
+        pool.join()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    report(stats, started, 'Done: ')
+    if stats['skipped']:
+        sys.stderr.write('Skipped %d files scanned before\n' %
+                         stats['skipped'])
+
+
+def main(args):
+    if args[:1] == ['scan']:
+        scan(args[1:])
+    elif args[:1] == ['daemon']:
+        daemon.main(args[1:])
+    else:
+        sys.stderr.write('Usage: python -m detection scan|daemon ...\n')
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -17,9 +17,6 @@
 
 from __future__ import absolute_import
 
-import os
-import tempfile
-
 import pywikibot
 
 from detection.by_ending.ffmpeg import strace_detect as ffmpeg_detector
@@ -28,7 +25,7 @@ from detection.by_ending.parsers import ParserDetector
 from detection.by_ending.pefile import detect as pefile_detect
 from detection.by_ending.pillow import detect as pillow_detector
 from detection.by_ending.wave import detect as wave_detector
-from detection.utils import filetype
+from detection.utils import carve, filetype, getsize
 
 UNKNOWN_TYPES = ['application/octet-stream', 'text/plain']
 ARCHIVE_TYPES = ['application/rar',
@@ -47,10 +44,12 @@ ARCHIVE_TYPES = ['application/rar',
 
 
 def detect(f):
-    trailers = ['\x00', '\x20', '\r', '\n', '\r\n']
+    return list(detect_iter(f))
 
-    size = os.path.getsize(f)
 
+def find_end(f):
+    # Where the file's own data ends, as (minor, pos, posexact); pos is None
+    # if that cannot be told
     major, minor = filetype(f).split('/')
 
     detector = None
@@ -93,24 +92,37 @@ def detect(f):
         detector = pefile_detect
     elif minor in [typ.split('/')[1] for typ in ARCHIVE_TYPES]:
         # Recursed archival formats
-        return
+        return minor, None, False
     elif minor in [typ.split('/')[1] for typ in UNKNOWN_TYPES]:
         # Recursed unknown formats
-        return
+        return minor, None, False
     else:
         pywikibot.warning('FIXME: Unexpected mime: ' + filetype(f))
-        return
+        return minor, None, False
     if not detector:
         pywikibot.warning('FIXME: Unsupported mime: ' + filetype(f))
-        return
+        return minor, None, False
 
     detection = detector(f)
     if not detection:
         pywikibot.warning('FIXME: Failed detection')
-        return
+        return minor, None, False
 
     pos, posexact = detection
-    if pos == size:
+    return minor, pos, posexact
+
+
+def detect_iter(f, end=None):
+    # Results come in file order, each as soon as it is known. end is what
+    # find_end() says, if it is known already.
+    trailers = ['\x00', '\x20', '\r', '\n', '\r\n']
+
+    size = getsize(f)
+
+    if end is None:
+        end = find_end(f)
+    minor, pos, posexact = end
+    if pos is None or pos == size:
         return
     elif not pos:
         pywikibot.warning('FIXME: Failed detection')
@@ -124,35 +136,23 @@ def detect(f):
         return
 
     # Split and analyze
-    chunk_size = 1 << 20
-
     mime = None
-    with open(f, 'rb') as fin:
-        with tempfile.NamedTemporaryFile() as tmp:
-            fin.seek(pos)
-            while True:
-                read = fin.read(chunk_size)
-                if not read:
-                    break
-                tmp.write(read)
-
-            tmp.flush()
-            # __import__('shutil').copyfile(tmp.name, '/tmp/test')
-            mime = filetype(tmp.name), filetype(tmp.name, False)
-            if mime[0] in UNKNOWN_TYPES:
-                if pos > 0.8 * size:
-                    return
-                if minor == 'jpeg' and pos > 0.5 * size:
-                    return
-            elif size - pos < 512:
+    with carve(f, pos) as tail:
+        mime = filetype(tail), filetype(tail, False)
+        if mime[0] in UNKNOWN_TYPES:
+            if pos > 0.8 * size:
                 return
-
-            ret = detect(tmp.name) or []
-            for item in ret:
-                item['pos'] += pos
-
-    return [{
-        'pos': pos,
-        'posexact': posexact,
-        'mime': mime
-    }] + ret
+            if minor == 'jpeg' and pos > 0.5 * size:
+                return
+        elif size - pos < 512:
+            return
+
+        yield {
+            'pos': pos,
+            'posexact': posexact,
+            'mime': mime
+        }
+
+        for item in detect_iter(tail):
+            item['pos'] += pos
+            yield item
@@ -19,7 +19,7 @@ from __future__ import absolute_import
 
 import traceback
 
-from detection.utils import FileProxy
+from detection.utils import FileProxy, open_file
 
 CHUNK_SIZE = 1 << 16
 
@@ -37,7 +37,7 @@ def find_marker(markers, startpos=0, cont=False):
         chunks = ('', '')
         lastpos = None
         try:
-            with FileProxy(open(f, 'rb'), track=False) as f:
+            with FileProxy(open_file(f), track=False) as f:
                 while True:
                     r = f.read(CHUNK_SIZE)
                     readpos += len(chunks[0])
@@ -69,7 +69,7 @@ def seek_trailers(f, pos, trailers):
     trailers.sort(key=lambda i: len(i), reverse=True)
     try:
         curtrailer = None
-        with FileProxy(open(f, 'rb'), track=False) as f:
+        with FileProxy(open_file(f), track=False) as f:
             f.seek(pos)
             testdata = f.read(len(trailers[0]))
             for trailer in trailers:
@@ -24,7 +24,7 @@ import xml.etree.ElementTree as ET
 
 import pywikibot
 
-from detection.utils import FileProxy  # , BinaryFileProxy
+from detection.utils import FileProxy, open_file  # , BinaryFileProxy
 
 
 matroska_spec = os.path.join(
@@ -49,7 +49,7 @@ class ParserDetector(object):
         self.lastgoodpos = 0
 
     def parse(self, parsetype):
-        with FileProxy(open(self.path, 'rb'), track=False) as f:
+        with FileProxy(open_file(self.path), track=False) as f:
             try:
                 if parsetype == 'ogg':
                     self.parse_ogg(f)
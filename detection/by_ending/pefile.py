@@ -22,11 +22,16 @@ import traceback
 
 import pefile
 
-pefile.fast_load = True
+from detection.utils import MemoryFile
 
 
 def detect(f):
-    with contextlib.closing(pefile.PE(f)) as f:
+    if isinstance(f, MemoryFile):
+        pe = pefile.PE(data=f.data, fast_load=True)
+    else:
+        pe = pefile.PE(f, fast_load=True)
+
+    with contextlib.closing(pe) as f:
         try:
             return max(section.PointerToRawData+section.SizeOfRawData
                        for section in f.sections), True
@@ -22,13 +22,13 @@ import traceback
 from PIL import Image
 from PIL import ImageFile
 
-from detection.utils import FileProxy
+from detection.utils import FileProxy, open_file
 
 ImageFile.MAXBLOCK = 1
 
 
 def detect(f):
-    with FileProxy(open(f, 'rb')) as f:
+    with FileProxy(open_file(f)) as f:
         try:
             image = Image.open(f)
 
@@ -39,9 +39,10 @@ class SyscallTracer(object):
             if not self.debugger:
                 break
 
-            # Wait until next syscall enter
+            # Wait until next syscall enter. Only for our own child: waiting
+            # for any would reap the children of other threads.
             try:
-                event = self.debugger.waitSyscall()
+                event = self.debugger.waitSyscall(process)
                 process = event.process
             except ProcessExit as event:
                 continue
@@ -21,13 +21,13 @@ import traceback
 
 import wave
 
-from detection.utils import FileProxy
+from detection.utils import FileProxy, open_file
 
 FRAMES_READ = 256
 
 
 def detect(f):
-    with FileProxy(open(f, 'rb')) as f:
+    with FileProxy(open_file(f)) as f:
         try:
             wav = wave.open(f)
 
@@ -17,19 +17,26 @@
 
 from __future__ import absolute_import
 
+import mmap
+import multiprocessing
 import os
 import struct
-import tempfile
 import traceback
 
 import pywikibot
 
-from detection.utils import FileProxy, filetype
+from detection.utils import (FileProxy, MemoryFile, carve, filetype,
+                             getsize, open_file)
 
 detectors = {}
 
 CHUNK_SIZE = 1 << 20
 
+# Scans of more than this are split over processes, giving each at least
+# PARALLEL_RANGE_MIN of the file
+PARALLEL_THRESHOLD = 1 << 28
+PARALLEL_RANGE_MIN = 1 << 26
+
 
 class FileCorrupted(Exception):
     pass
@@ -74,8 +81,9 @@ def findall(string, substr):
         index += length
 
 
-def find_startpos(f, magic):
-    readpos = 0
+def find_startpos(f, magic, start=0, end=None):
+    # Reading from start, which f must be at, up to end
+    readpos = start
     chunks = ('', '')
     poss = set()
     try:
@@ -86,26 +94,105 @@ def find_startpos(f, magic):
 
             for pos in findall(''.join(chunks), magic):
                 pos += readpos
+                if end is not None and pos >= end:
+                    continue
                 if pos not in poss:
                     yield pos
                     poss.add(pos)
 
-            if not r:
+            # Everything before the new chunk has been seen in full
+            if not r or (end is not None and readpos + len(chunks[0]) >= end):
                 break
     except Exception:
         traceback.print_exc()
         return
 
 
-def detect(f):
-    with UpdatingFileProxy(open(f, 'rb')) as f:
-        ret = []
+def scan_range(args):
+    # Signatures starting in [begin, end); the overlap catches those that
+    # cross end
+    path, magics, begin, end, overlap = args
+    ret = {}
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            limit = min(end + overlap, len(m))
+            for magic in magics:
+                ret[magic] = []
+                pos = m.find(magic, begin, limit)
+                while pos != -1 and pos < end:
+                    ret[magic].append(pos)
+                    pos = m.find(magic, pos + len(magic), limit)
+        finally:
+            m.close()
+    return ret
+
+
+def scan_workers(size):
+    free = multiprocessing.cpu_count() - int(os.getloadavg()[0])
+    return max(1, min(free, size // PARALLEL_RANGE_MIN))
+
+
+def parallel_startpos(path, magics, start=0, end=None):
+    # Every position of every magic in [start, end), keyed by magic, or None
+    # if the file is not worth splitting
+    if multiprocessing.current_process().daemon:
+        # In a pool already, which has the cores busy with other files and
+        # cannot have processes of its own
+        return None
+
+    size = os.path.getsize(path)
+    if end is not None:
+        size = min(size, end)
+    workers = scan_workers(size - start)
+    if workers < 2:
+        return None
+
+    overlap = max(len(magic) for magic in magics)
+    step = -(-(size - start) // workers)
+    ranges = [(path, magics, begin, min(begin + step, size), overlap)
+              for begin in range(start, size, step)]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(scan_range, ranges)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    ret = {}
+    for magic in magics:
+        ret[magic] = []
+        for res in results:
+            ret[magic] += res[magic]
+    return ret
+
+
+def detect(src, start=0, end=None):
+    return list(detect_iter(src, start, end))
+
+
+def detect_iter(src, start=0, end=None):
+    # Only what starts at or after start, and before end
+    candidates = None
+    size = getsize(src) if end is None else end
+    if not isinstance(src, MemoryFile) and \
+            size - start >= PARALLEL_THRESHOLD:
+        candidates = parallel_startpos(src, list(set(detectors.values())),
+                                       start, end)
+
+    with UpdatingFileProxy(open_file(src)) as f:
         for detector, magic in detectors.items():
             f.unset_pos()
-            f.seek(0, os.SEEK_SET)
+            f.seek(start, os.SEEK_SET)
 
             # search for magic
-            for startpos in list(find_startpos(f, magic)):
+            if candidates is not None:
+                startposs = candidates[magic]
+            else:
+                startposs = list(find_startpos(f, magic, start, end))
+
+            for startpos in startposs:
                 # print detector, magic, startpos
                 f.seek(startpos)
                 try:
@@ -124,24 +211,14 @@ def detect(f):
                     pywikibot.warning('Very small file?!')
                     continue
 
-                with tempfile.NamedTemporaryFile() as tmp:
-                    f.seek(startpos)
-                    while True:
-                        read = f.read(CHUNK_SIZE)
-                        if not read:
-                            break
-                        tmp.write(read)
-
-                    tmp.flush()
-                    mime = filetype(tmp.name), filetype(tmp.name, False)
+                with carve(src, startpos) as tmp:
+                    mime = filetype(tmp), filetype(tmp, False)
 
-                ret.append({
+                yield {
                     'pos': startpos,
                     'len': size,
                     'mime': mime
-                })
-
-        return ret
+                }
 
 
 for lib in ['cab', 'rar', '7z']:
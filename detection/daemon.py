@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+from __future__ import absolute_import
+
+import json
+import multiprocessing
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import traceback
+
+from detection import detect
+from detection.utils import MemoryFile, private_dir
+
+# Requests are one line of JSON each, {"path": ...} for a file the daemon can
+# read itself or {"size": ...} followed by that many bytes of file, and
+# optionally "stop" and "thorough" (see detect()); responses are one line of
+# JSON, {"result": [...]} or {"error": ...}. There is no authentication: the
+# socket is only for our own account, and sits in a private directory.
+SOCKET_DIR = os.path.join(os.path.expanduser('~'), '.embeddeddata')
+SOCKET_PATH = os.path.join(SOCKET_DIR, 'detect.sock')
+POOL_SIZE = multiprocessing.cpu_count()
+
+
+class DetectionError(Exception):
+    pass
+
+
+class DetectionHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        # Connections are kept open for any number of requests
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            try:
+                request = json.loads(line)
+                if 'path' in request:
+                    f = request['path']
+                else:
+                    data = self.rfile.read(request['size'])
+                    if len(data) < request['size']:
+                        break
+                    f = MemoryFile(data)
+
+                response = {'result': self.server.pool.apply(
+                    detect, (f, request.get('stop', False),
+                             request.get('thorough', False)))}
+            except Exception as e:
+                traceback.print_exc()
+                response = {'error': '%s: %s' % (type(e).__name__, e)}
+
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class DetectionServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+    # Detection runs in a pool of processes forked once, with every
+    # detector already imported.
+    daemon_threads = True
+
+    def __init__(self, path=SOCKET_PATH, pool_size=POOL_SIZE):
+        self.pool = multiprocessing.Pool(pool_size)
+
+        private_dir(os.path.dirname(os.path.abspath(path)))
+        if os.path.exists(path):
+            os.remove(path)
+        # Not even briefly open to others
+        umask = os.umask(0o177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path,
+                                                   DetectionHandler)
+        finally:
+            os.umask(umask)
+
+
+class DetectionClient(object):
+    # A drop-in for detect() that sends the work to the daemon. Paths must
+    # be readable by the daemon; files in memory are sent over. With
+    # fallback, files are checked locally while the daemon is unreachable.
+
+    def __init__(self, path=SOCKET_PATH, fallback=False):
+        self.path = path
+        self.fallback = fallback
+        self.sock = None
+        self.rfile = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.rfile = self.sock.makefile('rb')
+
+    def close(self):
+        if self.rfile is not None:
+            self.rfile.close()
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = self.rfile = None
+
+    def request(self, header, payload=''):
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    self.sock.sendall(json.dumps(header) + '\n' + payload)
+                    line = self.rfile.readline()
+                    if not line:
+                        raise socket.error('Connection closed by daemon')
+                    return json.loads(line)
+                except socket.error:
+                    # Maybe the daemon restarted since, try once more
+                    self.close()
+                    if attempt:
+                        raise
+
+    def __call__(self, f, stop=False, thorough=False):
+        header = {'stop': stop, 'thorough': thorough}
+        try:
+            if isinstance(f, MemoryFile):
+                header['size'] = len(f)
+                response = self.request(header, f.data)
+            else:
+                header['path'] = os.path.abspath(f)
+                response = self.request(header)
+        except socket.error:
+            if not self.fallback:
+                raise
+            traceback.print_exc()
+            return detect(f, stop, thorough)
+
+        if 'error' in response:
+            raise DetectionError(response['error'])
+
+        ret = response['result']
+        for item in ret:
+            item['mime'] = tuple(item['mime'])
+        return ret
+
+
+def main(args):
+    path = SOCKET_PATH
+    pool_size = POOL_SIZE
+    for arg in args:
+        if arg.startswith('-socket:'):
+            path = arg[len('-socket:'):]
+        elif arg.startswith('-pool:'):
+            pool_size = int(arg[len('-pool:'):])
+
+    server = DetectionServer(path, pool_size)
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -33,7 +33,10 @@ def register_detector(name, accepts):
 
 
 def detect(f):
-    ret = []
+    return list(detect_iter(f))
+
+
+def detect_iter(f):
     major, minor = filetype(f).split('/')
 
     for middleware, accepts in middlewares.items():
@@ -41,12 +44,10 @@ def detect(f):
             try:
                 for item in middleware(f) or []:
                     item['middleware'] = middleware.middleware_name
-                    ret.append(item)
+                    yield item
             except Exception:
                 traceback.print_exc()
 
-    return ret
-
 
 for lib in ['ffmpeg', 'pdfminer', 'ffc']:
     __import__('detection.middleware.' + lib)
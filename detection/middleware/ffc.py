@@ -23,6 +23,7 @@ import traceback
 
 from detection.by_magic import find_startpos
 from detection.middleware import register_detector
+from detection.utils import open_file
 
 
 retdct = {
@@ -36,14 +37,14 @@ retdct = {
 @register_detector('Anti_FFC',
                    lambda major, minor: True)
 def anti_ffc(f):
-    with open(f, 'rb') as fp:
+    with open_file(f) as fp:
         for pos in list(find_startpos(fp, b'\xff\xd9\xff\xd9')):
             if try_pos(f, pos):
                 return [retdct.copy()]
 
 
 def try_pos(f, pos):
-    with open(f, 'rb') as fp:
+    with open_file(f) as fp:
         fp.seek(pos, os.SEEK_SET)
         if fp.read(4) != b'\xff\xd9\xff\xd9':
             return
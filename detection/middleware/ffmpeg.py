@@ -21,6 +21,7 @@ import tempfile
 
 from detection.by_magic import detect as magic_detect
 from detection.middleware import register_detector
+from detection.utils import as_path
 
 
 @register_detector('Remux_Matroska',
@@ -28,7 +29,7 @@ from detection.middleware import register_detector
                    major in ['audio', 'video'] and minor not in ['midi', 'mid']
                    or minor in ['ogg'])
 def ffmpeg_remux_mkv(f):
-    with tempfile.NamedTemporaryFile(suffix='.mkv') as tmp:
+    with as_path(f) as f, tempfile.NamedTemporaryFile(suffix='.mkv') as tmp:
         args = ['ffmpeg',
                 '-loglevel', 'warning',
                 '-y',
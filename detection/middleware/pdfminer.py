@@ -17,7 +17,6 @@
 
 from __future__ import absolute_import
 
-import tempfile
 import traceback
 
 from pdfminer.pdfdocument import PDFDocument
@@ -27,7 +26,7 @@ from pdfminer.psparser import LIT
 
 from detection.by_magic import detect as magic_detect
 from detection.middleware import register_detector
-from detection.utils import filetype
+from detection.utils import MemoryFile, filetype, open_file
 
 LITERAL_FILESPEC = LIT('Filespec')
 LITERAL_EMBEDDEDFILE = LIT('EmbeddedFile')
@@ -40,7 +39,7 @@ LITERAL_EMBEDDEDFILE = LIT('EmbeddedFile')
 def pdfminer_EmbeddedFile(f):
     ret = []
 
-    with open(f, 'rb') as fp:
+    with open_file(f) as fp:
         parser = PDFParser(fp)
         doc = PDFDocument(
             parser,
@@ -69,17 +68,15 @@ def pdfminer_EmbeddedFile(f):
                     continue
 
                 if len(data):
-                    with tempfile.NamedTemporaryFile() as tmp:
-                        tmp.write(data)
-                        tmp.flush()
-                        del obj, data  # save some memory, hopefully
-                        ret.append({
-                            'pos': 0,
-                            'mime': (filetype(tmp.name),
-                                     filetype(tmp.name, False))
-                        })
+                    data = MemoryFile(data)
+                    del obj  # save some memory, hopefully
+                    ret.append({
+                        'pos': 0,
+                        'mime': (filetype(data), filetype(data, False))
+                    })
+                    del data
 
-                        for item in magic_detect(f) or []:
-                            if item['pos']:
-                                ret.append(item)
+                    for item in magic_detect(f) or []:
+                        if item['pos']:
+                            ret.append(item)
     return ret
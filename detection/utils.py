@@ -15,23 +15,110 @@
 # along with self program.  If not, see <http://www.gnu.org/licenses/>
 #
 
+import contextlib
+import errno
+import io
 import os
+import stat
 import subprocess
+import tempfile
 
 
-def filetype(path, mime=True):
-    args = ['file', path, '-b']
+class MemoryFile(object):
+    # Files small enough to be kept in memory go through detection as one of
+    # these instead of a path. Use the helpers below to access either.
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+
+def open_file(f):
+    if isinstance(f, MemoryFile):
+        return io.BytesIO(f.data)
+    return open(f, 'rb')
+
+
+def getsize(f):
+    if isinstance(f, MemoryFile):
+        return len(f)
+    return os.path.getsize(f)
+
+
+@contextlib.contextmanager
+def as_path(f, suffix=''):
+    # For detectors that hand the file to other programs
+    if not isinstance(f, MemoryFile):
+        yield f
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+        tmp.write(f.data)
+        tmp.flush()
+        yield tmp.name
+
+
+@contextlib.contextmanager
+def carve(f, pos, chunk_size=1 << 20):
+    # Everything from pos onwards, as a file of its own
+    if isinstance(f, MemoryFile):
+        yield MemoryFile(f.data[pos:])
+        return
+
+    with open(f, 'rb') as fin:
+        with tempfile.NamedTemporaryFile() as tmp:
+            fin.seek(pos)
+            while True:
+                read = fin.read(chunk_size)
+                if not read:
+                    break
+                tmp.write(read)
+
+            tmp.flush()
+            yield tmp.name
+
+
+def filetype(f, mime=True):
+    if isinstance(f, MemoryFile):
+        args = ['file', '-', '-b']
+    else:
+        args = ['file', f, '-b']
     if mime:
         # not '-i' because we don't need '; charset=binary'
         args.append('--mime-type')
 
-    val = subprocess.check_output(args).strip()
+    if isinstance(f, MemoryFile):
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        val = proc.communicate(f.data)[0]
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, args)
+        val = val.strip()
+    else:
+        val = subprocess.check_output(args).strip()
 
     if mime:
         val = val.replace('/x-', '/')
     return val
 
 
+def private_dir(directory):
+    # Create a directory only we can get into, or refuse one that someone
+    # else might have made for us
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise OSError(errno.EPERM, 'Directory is not ours', directory)
+    if stat.S_IMODE(st.st_mode) != 0o700:
+        os.chmod(directory, 0o700)
+
+
 class FileProxy(object):
     CHUNK_SIZE = 1 << 20
 
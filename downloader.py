@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+import hashlib
+import time
+
+import pywikibot
+import requests
+from pywikibot.comms import http
+
+CHUNK_SIZE = 1 << 20
+MAX_ATTEMPTS = 8
+BACKOFF_MAX = 60
+POOL_SIZE = 4
+TIMEOUT = 60
+
+
+class Downloader(object):
+    # Streams a file while hashing it. An interrupted download carries on
+    # where it stopped with a Range request, over the same pooled keep-alive
+    # connections, and only complete data with the expected SHA-1 counts.
+
+    def __init__(self, attempts=MAX_ATTEMPTS, timeout=TIMEOUT, session=None):
+        self.attempts = attempts
+        self.timeout = timeout
+
+        if session is None:
+            session = requests.Session()
+            session.headers['User-Agent'] = http.user_agent()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+
+    def fetch(self, url, sha1, fout, size=None):
+        # Into fout, an empty file open for writing
+        digest = hashlib.sha1()
+        offset = 0
+
+        for i in range(self.attempts):
+            if i:
+                time.sleep(min(2 ** i, BACKOFF_MAX))
+
+            # Ranges of compressed responses are of no use
+            headers = {'Accept-Encoding': 'identity'}
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+
+            try:
+                resp = self.session.get(url, headers=headers, stream=True,
+                                        timeout=(10, self.timeout))
+                try:
+                    if offset and resp.status_code == 416:
+                        # Nothing left
+                        pass
+                    else:
+                        resp.raise_for_status()
+                        if offset and resp.status_code != 206:
+                            # Range not honored, from the start then
+                            pywikibot.warning('Restarting download of %s' %
+                                              url)
+                            digest = hashlib.sha1()
+                            offset = 0
+                            fout.seek(0)
+                            fout.truncate()
+
+                        for chunk in resp.iter_content(CHUNK_SIZE):
+                            fout.write(chunk)
+                            digest.update(chunk)
+                            offset += len(chunk)
+                finally:
+                    resp.close()
+            except (requests.RequestException, IOError) as e:
+                pywikibot.warning(
+                    'Download of %s interrupted after %d bytes on attempt '
+                    '%d: %s' % (url, offset, i, e))
+                continue
+
+            if size is not None and offset < size:
+                pywikibot.warning(
+                    'Download of %s ended after %d of %d bytes on attempt '
+                    '%d' % (url, offset, size, i))
+                continue
+
+            if digest.hexdigest() == sha1:
+                return True
+
+            pywikibot.warning('SHA-1 mismatch for %s on attempt %d' % (
+                url, i))
+            digest = hashlib.sha1()
+            offset = 0
+            fout.seek(0)
+            fout.truncate()
+
+        return False
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+LEASE_TTL = 900
+LEASE_RETRY = 60  # Seconds before a file leased by another worker is retried
+
+# Extend our own lease, or take it back if it expired and nobody else took it
+RENEW = """
+local value = redis.call('GET', KEYS[1])
+if value and value ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class Leases(object):
+    # One lease per title over all workers, so only one of them acts on a
+    # file at a time. Every lease is fenced with a new, higher token; a worker
+    # that stalled past the TTL and was overtaken finds out on renew() and
+    # must not touch the file any more.
+
+    def __init__(self, redis, key, ttl=LEASE_TTL):
+        self.redis = redis
+        self.key = key + ':lease'
+        self.ttl = ttl
+
+        self.renew_script = redis.register_script(RENEW)
+        self.release_script = redis.register_script(RELEASE)
+
+        self.current = None  # (title, token)
+
+    def lease_key(self, title):
+        return u'%s:%s' % (self.key, title)
+
+    def acquire(self, title):
+        self.release()
+
+        token = self.redis.incr(self.key + ':fence')
+        if not self.redis.set(self.lease_key(title), token, nx=True,
+                              px=int(self.ttl * 1000)):
+            return None
+
+        self.current = title, token
+        return token
+
+    def renew(self):
+        if not self.current:
+            return False
+
+        title, token = self.current
+        if self.renew_script(keys=[self.lease_key(title)],
+                             args=[token, int(self.ttl * 1000)]):
+            return True
+
+        self.current = None
+        return False
+
+    def release(self):
+        if not self.current:
+            return
+
+        title, token = self.current
+        self.current = None
+        self.release_script(keys=[self.lease_key(title)], args=[token])
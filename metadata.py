@@ -0,0 +1,191 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+import collections
+import threading
+import time
+
+import pywikibot
+from pywikibot.page import FileInfo
+
+# Same as what pywikibot loads for FileInfo
+IIPROP = 'timestamp|user|comment|url|size|sha1|mime|metadata|archivename'
+
+BATCH_SIZE = 50
+CACHE_TTL = 120
+CACHE_SIZE = 1000
+
+
+def batches(items, size=BATCH_SIZE):
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+def latest_imageinfo(api, titles, iiprop='timestamp|user|size|sha1|mime'):
+    # Only the current revision of each file, keyed by title. Pages that do
+    # not exist (yet, as seen from a lagging replica) are left out.
+    def query(titles):
+        return api.query({
+            'action': 'query',
+            'titles': titles,
+            'prop': 'imageinfo',
+            'iiprop': iiprop,
+        }, len(titles))
+
+    ret = {}
+    for res in api.map(query, batches(titles)):
+        names = {}
+        for item in res['query'].get('normalized', []):
+            names[item['to']] = item['from']
+
+        for page in res['query']['pages'].values():
+            if page.get('imageinfo'):
+                title = names.get(page['title'], page['title'])
+                ret[title] = page['imageinfo'][0]
+
+    return ret
+
+
+class FileMetadata(object):
+    def __init__(self, title, page):
+        self.title = title
+        self.fetched = time.time()
+        self.exists = 'missing' not in page and 'invalid' not in page
+        self.pageid = page.get('pageid', 0)
+        self.imageinfo = page.get('imageinfo', [])
+        self.globalusage = page.get('globalusage', [])
+
+    def latest_timestamp(self):
+        if not self.imageinfo:
+            return None
+        return max(pywikibot.Timestamp.fromISOformat(info['timestamp'])
+                   for info in self.imageinfo)
+
+    def apply(self, filepage):
+        # Make pywikibot use this instead of querying again
+        filepage._pageid = self.pageid
+        filepage._file_revisions.clear()
+        for info in self.imageinfo:
+            info = FileInfo(info)
+            filepage._file_revisions[info.timestamp] = info
+        filepage._globalusage = self.globalusage
+
+
+class MetadataPrefetcher(object):
+    # Page existence, the full file history and the global usage of several
+    # files in one combined query.
+
+    def __init__(self, api, ttl=CACHE_TTL, maxsize=CACHE_SIZE):
+        self.api = api
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+        self.cache = collections.OrderedDict()  # title -> FileMetadata
+        self.pending = set()
+        self.lock = threading.RLock()
+
+    def lookup(self, title):
+        with self.lock:
+            try:
+                record = self.cache.pop(title)
+            except KeyError:
+                return None
+            if record.fetched + self.ttl < time.time():
+                return None
+
+            self.cache[title] = record
+            return record
+
+    def store(self, record):
+        with self.lock:
+            self.cache.pop(record.title, None)
+            self.cache[record.title] = record
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def invalidate(self, title):
+        with self.lock:
+            self.cache.pop(title, None)
+
+    def prefetch(self, titles):
+        with self.lock:
+            for title in titles:
+                if title and self.lookup(title) is None:
+                    self.pending.add(title)
+
+    def flush(self):
+        with self.lock:
+            titles = list(self.pending)
+            self.pending.clear()
+
+        self.api.map(self.query_batch, batches(titles))
+
+    def query_batch(self, titles):
+        try:
+            self.query(titles)
+        except Exception as e:
+            pywikibot.exception(e)
+
+    def query(self, titles):
+        params = {
+            'action': 'query',
+            'titles': titles,
+            'prop': ['imageinfo', 'globalusage'],
+            'iiprop': IIPROP,
+            'iilimit': 'max',
+            'gulimit': 'max',
+        }
+
+        pages = {}
+        names = {title: title for title in titles}
+        items = len(titles)
+        while True:
+            res = self.api.query(params, items)
+            items = 0
+
+            for item in res['query'].get('normalized', []):
+                names[item['to']] = names.pop(item['from'], item['from'])
+
+            for page in res['query']['pages'].values():
+                merged = pages.setdefault(page['title'], page)
+                if merged is page:
+                    continue
+                # Continued queries return more of the same lists
+                for key in ['imageinfo', 'globalusage']:
+                    merged.setdefault(key, []).extend(page.get(key, []))
+
+            if 'continue' not in res:
+                break
+            params.update(res['continue'])
+
+        for title, page in pages.items():
+            self.store(FileMetadata(names.get(title, title), page))
+
+    def get(self, title, timestamp=None, force=False):
+        record = None if force else self.lookup(title)
+
+        # Queued before a newer revision was uploaded
+        if record and timestamp and (record.latest_timestamp() or
+                                     timestamp) < timestamp:
+            record = None
+
+        if record is None:
+            with self.lock:
+                self.pending.add(title)
+            self.flush()
+            record = self.lookup(title)
+
+        return record
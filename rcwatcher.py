@@ -15,51 +15,265 @@
 # along with self program.  If not, see <http://www.gnu.org/licenses/>
 #
 
+import collections
 import json
-import signal
+import threading
+import time
+import traceback
 
 from redis import Redis
 
 import pywikibot
-from pywikibot.comms.eventstreams import site_rc_listener
+from pywikibot.site import APISite
 
+from apiclient import ApiClient
 from config import REDIS_KEY
+from metadata import latest_imageinfo
+from sse import STREAM_URL, EventStream
+from userinfo import EXPERIENCED_EDITCOUNT, UserInfo
+from workqueue import WorkQueue, enqueue, queue_key
 
-TIMEOUT = 60  # We expect at least one rc entry every minute
+FLUSH_INTERVAL = 0.5
+BATCH_SIZE = 100
+DEDUP_WINDOW = 30
 
 
-class TimeoutError(Exception):
-    pass
+class Publisher(object):
+    # Queue compact records in micro-batches through one pipeline, dropping
+    # repeats of the same title and revision seen within DEDUP_WINDOW.
+    # Records may go to different queues, the checkpoint is shared.
 
+    def __init__(self, redis, checkpoint_key, interval=FLUSH_INTERVAL,
+                 batch_size=BATCH_SIZE, window=DEDUP_WINDOW, enrich=None):
+        self.redis = redis
+        self.checkpoint_key = checkpoint_key
+        self.enrich = enrich
+        self.interval = interval
+        self.batch_size = batch_size
+        self.window = window
 
-def on_timeout(signum, frame):
-    raise TimeoutError
+        self.batch = []
+        self.seen = collections.OrderedDict()  # (key, title, rev) -> time
+        self.last_id = self.flushed_id = None
+        self.lock = threading.Lock()
+        # Held for a whole flush, so batches and checkpoints are stored in
+        # order and a failed batch is put back before the next one is taken
+        self.flush_lock = threading.Lock()
 
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
 
-def run_watcher():
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def publish(self, key, record):
+        dedup = key, record['title'], record['log_params'].get('img_timestamp')
+        now = time.time()
+
+        with self.lock:
+            while self.seen and \
+                    next(self.seen.itervalues()) < now - self.window:
+                self.seen.popitem(last=False)
+            if dedup in self.seen:
+                return
+
+            self.seen[dedup] = now
+            self.batch.append((key, record))
+            full = len(self.batch) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def checkpoint(self, event_id):
+        # Everything up to this event is either published or in the batch
+        with self.lock:
+            self.last_id = event_id
+
+    def resume_id(self):
+        return self.redis.get(self.checkpoint_key)
+
+    def flush(self):
+        with self.flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self.lock:
+            batch, self.batch = self.batch, []
+            last_id = self.last_id
+        if batch and self.enrich:
+            batch = self.enrich(batch)
+        if not batch and last_id == self.flushed_id:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        for key, record in batch:
+            enqueue(pipe, key, record)
+        try:
+            results = pipe.execute(raise_on_error=False)
+        except Exception:
+            with self.lock:
+                self.batch[:0] = batch
+            raise
+
+        # Without a transaction the other commands went through, only the
+        # failed records are tried again
+        failed = [(item, result) for item, result in zip(batch, results)
+                  if isinstance(result, Exception)]
+        if failed:
+            with self.lock:
+                self.batch[:0] = [item for item, result in failed]
+            raise failed[0][1]
+
+        # Only once everything up to it is queued
+        if last_id:
+            self.redis.set(self.checkpoint_key, last_id)
+        self.flushed_id = last_id
+
+
+class Enricher(object):
+    # Attach what the workers would look up anyway to a batch of records
+    # and drop the ones they would certainly skip.
+
+    def __init__(self, sites, queues):
+        self.sites = sites
+        self.queues = queues
+        self.apis = {dbname: ApiClient(site)
+                     for dbname, site in sites.items()}
+        self.userinfo = {dbname: UserInfo(api)
+                         for dbname, api in self.apis.items()}
+
+    def __call__(self, batch):
+        wikis = collections.defaultdict(list)
+        for key, record in batch:
+            wikis[record['wiki']].append((key, record))
+
+        ret = []
+        for dbname, items in wikis.items():
+            ret += self.enrich(dbname, items)
+        return ret
+
+    def enrich(self, dbname, batch):
+        api = self.apis[dbname]
+        queue = self.queues[dbname]
+        userinfo = self.userinfo[dbname]
+
+        users = list(set(record['user'] for key, record in batch))
+        userinfo.prefetch(users)
+        userinfo.flush()
+
+        try:
+            infos = latest_imageinfo(
+                api, list(set(record['title'] for key, record in batch)))
+        except Exception as e:
+            pywikibot.exception(e)
+            infos = {}
+
+        try:
+            hits = dict(zip(users, queue.hits(users)))
+        except Exception:
+            traceback.print_exc()
+            hits = {}
+
+        ret = []
+        for key, record in batch:
+            editcount = userinfo.lookup(record['user'])
+            if editcount is not None:
+                if editcount > EXPERIENCED_EDITCOUNT:
+                    continue
+                record['editcount'] = editcount
+
+            # Only if it is still the revision of this event. Missing pages
+            # are kept, the replica we asked may be lagging.
+            info = infos.get(record['title'])
+            if info and pywikibot.Timestamp.fromISOformat(
+                    info['timestamp']).totimestampformat() == \
+                    record['log_params'].get('img_timestamp'):
+                record['imageinfo'] = {
+                    'sha1': info['sha1'],
+                    'size': info['size'],
+                    'mime': info['mime'],
+                }
+
+            ret.append((queue.band(record, hits.get(record['user'])), record))
+
+        return ret
+
+
+def compact(change):
+    # Only these are read by the workers
+    log_params = change.get('log_params') or {}
+    return {
+        'wiki': change['wiki'],
+        'title': change['title'],
+        'timestamp': change['timestamp'],
+        'user': change['user'],
+        'queued': time.time(),
+        'log_params': {key: log_params[key]
+                       for key in ['img_timestamp', 'img_sha1']
+                       if key in log_params},
+    }
+
+
+def is_upload(change):
+    return (
+        change['type'] == 'log' and
+        change['namespace'] == 6 and
+        change['log_type'] == 'upload'
+    )
+
+
+def run_watcher(dbnames=(), stream_url=STREAM_URL):
+    # One connection carries the events of every wiki
     site = pywikibot.Site(user="Embedded Data Bot")
+    sites = {site.dbName(): site}
+    for dbname in dbnames:
+        if dbname not in sites:
+            sites[dbname] = APISite.fromDBName(dbname)
     redis = Redis(host="tools-redis")
+    queues = {dbname: WorkQueue(redis, queue_key(site))
+              for dbname, site in sites.items()}
 
-    signal.signal(signal.SIGALRM, on_timeout)
-    signal.alarm(TIMEOUT)
+    publisher = Publisher(redis, REDIS_KEY + ':last-event-id',
+                          enrich=Enricher(sites, queues))
 
-    rc = site_rc_listener(site)
-    for change in rc:
-        signal.alarm(TIMEOUT)
+    last_id = publisher.resume_id()
+    if last_id:
+        pywikibot.output('Resuming from event %s' % last_id)
 
-        if (
-            change['type'] == 'log' and
-            change['namespace'] == 6 and
-            change['log_type'] == 'upload'
-        ):
-            redis.rpush(REDIS_KEY, json.dumps(change))
+    rc = EventStream(stream_url, last_id=last_id)
+    try:
+        for event_id, change in rc:
+            # Most events are not uploads, skip them without parsing
+            if 'upload' in change:
+                change = json.loads(change)
+                if change.get('wiki') in sites and is_upload(change):
+                    publisher.publish(queues[change['wiki']].key,
+                                      compact(change))
+
+            publisher.checkpoint(event_id)
+    finally:
+        publisher.flush()
 
     pywikibot.output("Exit - THIS SHOULD NOT HAPPEN")
 
 
 def main():
-    pywikibot.handleArgs()
-    run_watcher()
+    dbnames = []
+    stream_url = STREAM_URL
+    for arg in pywikibot.handleArgs():
+        if arg.startswith('-wiki:'):
+            dbnames.append(arg[len('-wiki:'):])
+        elif arg.startswith('-stream:'):
+            # e.g. a local stand-in for testing
+            stream_url = arg[len('-stream:'):]
+
+    run_watcher(dbnames, stream_url)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,272 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+import calendar
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+
+import pywikibot
+from pywikibot.page import FileInfo
+from redis import Redis
+
+from apiclient import ApiClient
+from cache import DownloadCache
+from detection import VERSION as DETECTOR_VERSION, detect
+from detection.daemon import DetectionClient
+from downloader import Downloader
+from worker import SPOOL_THRESHOLD, download
+from workqueue import REPORT_INTERVAL, WorkQueue, enqueue, lane_of, queue_key
+
+AIPROP = 'timestamp|user|url|size|sha1|mime'
+BATCH_SIZE = 50
+POOL_SIZE = 4
+
+
+def all_images(api, start=None, end=None):
+    # Oldest first, within [start, end]
+    params = {
+        'action': 'query',
+        'list': 'allimages',
+        'aisort': 'timestamp',
+        'aidir': 'ascending',
+        'aiprop': AIPROP,
+        'ailimit': BATCH_SIZE,
+    }
+    if start:
+        params['aistart'] = start
+    if end:
+        params['aiend'] = end
+
+    while True:
+        res = api.query(params, BATCH_SIZE)
+        for info in res['query']['allimages']:
+            yield info['title'], info
+
+        if 'continue' not in res:
+            break
+        params.update(res['continue'])
+
+
+def category_files(api, category):
+    params = {
+        'action': 'query',
+        'generator': 'categorymembers',
+        'gcmtitle': category,
+        'gcmtype': 'file',
+        'gcmlimit': BATCH_SIZE,
+        'prop': 'imageinfo',
+        'iiprop': AIPROP,
+    }
+
+    while True:
+        res = api.query(params, BATCH_SIZE)
+        for page in res.get('query', {}).get('pages', {}).values():
+            if page.get('imageinfo'):
+                yield page['title'], page['imageinfo'][0]
+
+        if 'continue' not in res:
+            break
+        params.update(res['continue'])
+
+
+def skip_scanned(redis, key, batch, stats):
+    # Leave out what the current detectors have seen already
+    if not batch:
+        return []
+
+    ret = []
+    versions = redis.hmget(key, [info['sha1'] for title, info in batch])
+    for item, version in zip(batch, versions):
+        if version == str(DETECTOR_VERSION):
+            stats['skipped'] += 1
+        else:
+            ret.append(item)
+    return ret
+
+
+def unscanned(redis, key, files, stats):
+    batch = []
+    for item in files:
+        batch.append(item)
+        if len(batch) == BATCH_SIZE:
+            for unseen in skip_scanned(redis, key, batch, stats):
+                yield unseen
+            batch = []
+
+    for unseen in skip_scanned(redis, key, batch, stats):
+        yield unseen
+
+
+def bounded(items, semaphore):
+    # Pool.imap would otherwise enumerate everything up front. This runs in
+    # the pool's feeder thread, where an exception would go unnoticed.
+    try:
+        for item in items:
+            semaphore.acquire()
+            yield item
+    except Exception as e:
+        pywikibot.exception(e)
+        pywikibot.warning('Enumeration failed, finishing early')
+
+
+# State of each pool process
+_downloader = None
+_cache = None
+_tmpdir = None
+_detect = None
+
+
+def init_scanner(tmpdir, daemon=None):
+    global _downloader, _cache, _tmpdir, _detect
+    _downloader = Downloader()
+    _cache = DownloadCache()
+    _tmpdir = tmpdir
+    _detect = DetectionClient(daemon, fallback=True) if daemon else detect
+
+
+def scan(item):
+    title, info = item
+    revision = FileInfo(info)
+    path = os.path.join(_tmpdir, str(uuid.uuid1()))
+    try:
+        success, f = download(_downloader, revision, path,
+                              revision.size <= SPOOL_THRESHOLD, _cache)
+        if not success:
+            return title, info, None
+        return title, info, _detect(f, stop=True)
+    except Exception:
+        traceback.print_exc()
+        return title, info, None
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def record_of(site, title, info):
+    # Like what the watcher queues
+    timestamp = pywikibot.Timestamp.fromISOformat(info['timestamp'])
+    return {
+        'wiki': site.dbName(),
+        'title': title,
+        'timestamp': calendar.timegm(timestamp.timetuple()),
+        'user': info['user'],
+        'log_params': {
+            'img_timestamp': timestamp.totimestampformat(),
+            'img_sha1': info['sha1'],
+        },
+        'imageinfo': {
+            'sha1': info['sha1'],
+            'size': info['size'],
+            'mime': info['mime'],
+        },
+        'rescan': True,
+    }
+
+
+def run_rescan(start=None, end=None, category=None, pool_size=POOL_SIZE,
+               endpoint=None, daemon=None):
+    tmpdir = DownloadCache().mkdtemp()
+    try:
+        # Before any threads are started
+        pool = multiprocessing.Pool(pool_size, init_scanner,
+                                    (tmpdir, daemon))
+
+        site = pywikibot.Site(user="Embedded Data Bot")
+        api = ApiClient(site, endpoint)
+        redis = Redis(host="tools-redis")
+        queue = WorkQueue(redis, queue_key(site))
+        scanned_key = queue.key + ':scanned'
+
+        if category:
+            files = category_files(api, category)
+        else:
+            files = all_images(api, start, end)
+
+        stats = {
+            'scanned': 0,
+            'skipped': 0,
+            'failed': 0,
+            'hits': 0,
+        }
+        semaphore = threading.BoundedSemaphore(pool_size * 2)
+        started = reported = time.time()
+        for title, info, res in pool.imap_unordered(
+                scan, bounded(unscanned(redis, scanned_key, files, stats),
+                              semaphore)):
+            semaphore.release()
+
+            if res is None:
+                stats['failed'] += 1
+                continue
+
+            stats['scanned'] += 1
+            redis.hset(scanned_key, info['sha1'], DETECTOR_VERSION)
+            if res:
+                # The workers check it again and act on it
+                stats['hits'] += 1
+                pywikibot.output('Hit: %s' % title)
+                record = record_of(site, title, info)
+                enqueue(redis, queue.bands(lane_of(record))[0], record)
+
+            if time.time() - reported > REPORT_INTERVAL:
+                pywikibot.output(
+                    'Scanned %(scanned)d, skipped %(skipped)d, failed '
+                    '%(failed)d, %(hits)d hits' % stats +
+                    ', %.1f files/s' % (
+                        stats['scanned'] / (time.time() - started)))
+                reported = time.time()
+
+        pool.close()
+        pool.join()
+
+        pywikibot.output('Done: scanned %(scanned)d, skipped %(skipped)d, '
+                         'failed %(failed)d, %(hits)d hits' % stats)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    start = end = category = endpoint = daemon = None
+    pool_size = POOL_SIZE
+    for arg in pywikibot.handleArgs():
+        if arg.startswith('-start:'):
+            start = arg[len('-start:'):]
+        elif arg.startswith('-end:'):
+            end = arg[len('-end:'):]
+        elif arg.startswith('-cat:'):
+            category = arg[len('-cat:'):]
+        elif arg.startswith('-pool:'):
+            pool_size = int(arg[len('-pool:'):])
+        elif arg.startswith('-api:'):
+            endpoint = arg[len('-api:'):]
+        elif arg.startswith('-daemon:'):
+            # Socket of a detection daemon run by the same account
+            daemon = arg[len('-daemon:'):]
+
+    run_rescan(start, end, category, pool_size, endpoint, daemon)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        pywikibot.stopme()
@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+import heapq
+import json
+import threading
+import time
+import traceback
+import uuid
+
+import pywikibot
+from redis.exceptions import ConnectionError, TimeoutError
+
+MAX_PENDING = 4096
+RETRY_DELAY = 10  # Seconds before a task is tried again after Redis failed
+
+actions = {}
+
+
+def register_action(name):
+    def decorator(f):
+        actions[name] = f
+        return f
+    return decorator
+
+
+class Scheduler(object):
+    # One thread and one heap for all delayed actions of a worker. The heap
+    # is only a local view; the Redis sorted set is the source of truth, so
+    # pending tasks survive restarts and whoever removes a task from the set
+    # first is the one that runs it.
+
+    def __init__(self, site, redis, key, max_pending=MAX_PENDING):
+        self.site = site
+        self.redis = redis
+        self.key = key + ':scheduled'
+        self.stats_key = key + ':scheduler:stats'
+        self.max_pending = max_pending
+
+        self.heap = []
+        self.cond = threading.Condition()
+        self.stats = {
+            'scheduled': 0,
+            'executed': 0,
+            'failed': 0,
+            'dropped': 0,
+        }
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.load()
+        self.thread.start()
+
+    def load(self):
+        with self.cond:
+            for task, due in self.redis.zrange(
+                    self.key, 0, -1, withscores=True):
+                heapq.heappush(self.heap, (due, task))
+            self.cond.notify()
+
+        if self.heap:
+            pywikibot.output('Restored %d scheduled tasks' % len(self.heap))
+
+    def schedule(self, delay, action, filepage, msg):
+        assert action in actions
+
+        with self.cond:
+            if len(self.heap) >= self.max_pending:
+                self.count('dropped')
+                pywikibot.warning('Scheduler full, dropping %s of %s' % (
+                    action, filepage))
+                return False
+
+            due = time.time() + delay
+            task = json.dumps({
+                'id': str(uuid.uuid1()),
+                'action': action,
+                'title': filepage.title(),
+                'msg': msg,
+            })
+            try:
+                self.redis.execute_command('ZADD', self.key, due, task)
+            except Exception:
+                traceback.print_exc()
+                self.count('dropped')
+                pywikibot.warning('Cannot store %s of %s, dropping it' % (
+                    action, filepage))
+                return False
+            heapq.heappush(self.heap, (due, task))
+            self.count('scheduled')
+            self.cond.notify()
+            return True
+
+    def count(self, stat):
+        self.stats[stat] += 1
+        try:
+            self.redis.hincrby(self.stats_key, stat, 1)
+        except Exception:
+            traceback.print_exc()
+
+    def run(self):
+        # Nothing may end this thread, or nothing scheduled would ever run
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                traceback.print_exc()
+                time.sleep(RETRY_DELAY)
+
+    def run_once(self):
+        with self.cond:
+            while not self.heap:
+                self.cond.wait()
+
+            due, task = self.heap[0]
+            delay = due - time.time()
+            if delay > 0:
+                self.cond.wait(delay)
+                return
+
+            heapq.heappop(self.heap)
+
+        # Another worker may have restored the same task
+        try:
+            removed = self.redis.zrem(self.key, task)
+        except (ConnectionError, TimeoutError):
+            traceback.print_exc()
+            with self.cond:
+                heapq.heappush(self.heap, (time.time() + RETRY_DELAY, task))
+            return
+        if not removed:
+            return
+
+        self.execute(task)
+
+    def execute(self, task):
+        try:
+            task = json.loads(task)
+            filepage = pywikibot.FilePage(self.site, task['title'])
+            actions[task['action']](filepage, task['msg'])
+        except Exception:
+            traceback.print_exc()
+            self.count('failed')
+        else:
+            self.count('executed')
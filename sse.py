@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+import time
+
+import pywikibot
+import requests
+from pywikibot.comms import http
+
+STREAM_URL = 'https://stream.wikimedia.org/v2/stream/recentchange'
+
+TIMEOUT = 60  # We expect at least one event every minute
+BACKOFF_MIN = 1
+BACKOFF_MAX = 60
+
+
+class EventStream(object):
+    # A Server-Sent Events consumer that reconnects by itself, resuming with
+    # Last-Event-ID (or since= for the very first connection).
+
+    def __init__(self, url=STREAM_URL, last_id=None, since=None,
+                 timeout=TIMEOUT):
+        self.url = url
+        self.last_id = last_id
+        self.since = since
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = http.user_agent()
+
+    def __iter__(self):
+        backoff = BACKOFF_MIN
+        while True:
+            try:
+                for item in self.connect():
+                    backoff = BACKOFF_MIN
+                    yield item
+            except requests.RequestException as e:
+                pywikibot.warning('Event stream interrupted: %s' % e)
+            else:
+                pywikibot.warning('Event stream closed by server')
+
+            pywikibot.output('Reconnecting in %d seconds' % backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, BACKOFF_MAX)
+
+    def connect(self):
+        headers = {'Accept': 'text/event-stream'}
+        params = {}
+        if self.last_id:
+            headers['Last-Event-ID'] = self.last_id
+        elif self.since:
+            params['since'] = self.since
+
+        resp = self.session.get(self.url, headers=headers, params=params,
+                                stream=True, timeout=(10, self.timeout))
+        try:
+            resp.raise_for_status()
+
+            event_id = self.last_id
+            event_type = None
+            data = []
+            for line in resp.iter_lines(chunk_size=None):
+                if not line:
+                    # Dispatch
+                    if data and event_type in [None, 'message']:
+                        self.last_id = event_id
+                        yield event_id, '\n'.join(data)
+                    event_type = None
+                    data = []
+                    continue
+                elif line.startswith(':'):
+                    # Comment, used as a heartbeat
+                    continue
+
+                field, _, value = line.partition(':')
+                if value.startswith(' '):
+                    value = value[1:]
+
+                if field == 'data':
+                    data.append(value)
+                elif field == 'id':
+                    event_id = value
+                elif field == 'event':
+                    event_type = value
+        finally:
+            resp.close()
@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+import collections
+import threading
+import time
+
+import pywikibot
+
+# Uploads by users with more edits than this are not checked
+EXPERIENCED_EDITCOUNT = 200
+
+BATCH_SIZE = 50  # list=users limit without apihighlimits
+CACHE_TTL = 3600
+CACHE_SIZE = 10000
+
+
+class UserInfo(object):
+    def __init__(self, api, ttl=CACHE_TTL, maxsize=CACHE_SIZE):
+        self.api = api
+        self.site = api.site
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+        self.cache = collections.OrderedDict()  # name -> (expiry, editcount)
+        self.pending = set()
+        self.lock = threading.RLock()
+
+    def lookup(self, name):
+        with self.lock:
+            try:
+                expiry, editcount = self.cache.pop(name)
+            except KeyError:
+                return None
+            if expiry < time.time():
+                return None
+
+            # Most recently used goes last
+            self.cache[name] = expiry, editcount
+            return editcount
+
+    def seed(self, name, editcount):
+        with self.lock:
+            self.cache.pop(name, None)
+            self.cache[name] = time.time() + self.ttl, editcount
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def prefetch(self, names):
+        with self.lock:
+            for name in names:
+                if name and self.lookup(name) is None:
+                    self.pending.add(name)
+
+    def flush(self):
+        with self.lock:
+            names = list(self.pending)
+            self.pending.clear()
+
+        self.api.map(self.query,
+                     [names[i:i+BATCH_SIZE]
+                      for i in range(0, len(names), BATCH_SIZE)])
+
+    def query(self, names):
+        try:
+            res = self.api.query({
+                'action': 'query',
+                'list': 'users',
+                'ususers': names,
+                'usprop': 'editcount',
+            }, len(names))
+        except Exception as e:
+            pywikibot.exception(e)
+            return
+
+        for user in res['query']['users']:
+            # Missing and invalid users have no edit count
+            self.seed(user['name'], user.get('editcount', 0))
+
+    def editcount(self, name):
+        editcount = self.lookup(name)
+        if editcount is None:
+            with self.lock:
+                self.pending.add(name)
+            self.flush()
+            editcount = self.lookup(name)
+
+        if editcount is None:
+            # Normalized differently from what we asked for
+            editcount = pywikibot.User(self.site, name).editCount(force=True)
+            self.seed(name, editcount)
+
+        return editcount
+
+    def is_experienced(self, name):
+        return self.editcount(name) > EXPERIENCED_EDITCOUNT
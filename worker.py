@@ -16,11 +16,16 @@
 #
 
 import datetime
-import json
+import errno
+import io
 import os
+import resource
 import shutil
+import signal
+import socket
 import tempfile
 import threading
+import time
 import traceback
 import uuid
 
@@ -29,14 +34,35 @@ from pywikibot.data.api import APIError
 from pywikibot.throttle import Throttle
 from redis import Redis
 
-from config import REDIS_KEY
-from detection import detect
+from admission import ADMISSION_RETRY, Admission
+from apiclient import ApiClient
+from cache import CACHE_SIZE, DownloadCache
+from detection import VERSION as DETECTOR_VERSION, detect
+from detection.daemon import DetectionClient
 from detection.by_ending import ARCHIVE_TYPES, UNKNOWN_TYPES
+from detection.utils import MemoryFile, SubFileProxy, open_file
+from downloader import Downloader
+from lease import LEASE_RETRY, Leases
+from metadata import MetadataPrefetcher
+from scheduler import Scheduler, register_action
+from userinfo import BATCH_SIZE, UserInfo
+from workqueue import LANES, REPORT_INTERVAL, WorkQueue, enqueue, queue_key
 
 
 MESSAGE_PREFIX = ('This file contains [[COM:CSD#F9|'
                   'embedded data]]: ')
 
+UPLOAD_CHUNK_SIZE = 1 << 22
+CHUNKED_UPLOAD_THRESHOLD = 1 << 26
+# Files up to this size are downloaded into and analyzed from memory
+SPOOL_THRESHOLD = 1 << 24
+
+# Supervised children are replaced after this many items, or once they have
+# used this much memory at some point
+MAX_JOBS = 1000
+MAX_RSS = 1 << 31
+RESTART_DELAY = 10
+
 
 def sizeof_fmt(num, suffix='B'):
     # Source: http://stackoverflow.com/a/1094933
@@ -47,10 +73,17 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
-def run_worker():
-    try:
-        tmpdir = tempfile.mkdtemp()
+def peak_rss():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
 
+def run_worker(spool_threshold=SPOOL_THRESHOLD, lanes=LANES,
+               cache_size=CACHE_SIZE, endpoint=None, consumer=None,
+               max_jobs=None, max_rss=None, daemon=None):
+    cache = DownloadCache(maxsize=cache_size)
+    tmpdir = cache.mkdtemp()
+    try:
         site = pywikibot.Site(user="Embedded Data Bot")
         site._throttle = Throttle(site, multiplydelay=False)
 
@@ -60,27 +93,103 @@ def run_worker():
         site.unlock_page = lambda *args, **kwargs: None  # noop
 
         redis = Redis(host="tools-redis")
-
+        queue = WorkQueue(redis, queue_key(site), lanes, consumer=consumer)
+        queue.join()
+
+        leases = Leases(redis, queue.key)
+        admission = Admission(redis, queue.key, tmpdir, queue.consumer,
+                              spool_threshold, cache)
+
+        @register_action('requeue')
+        def requeue(filepage, msg):
+            enqueue(redis, msg['stream'], msg['record'])
+
+        scheduler = Scheduler(site, redis, queue.key)
+        scheduler.start()
+
+        # Reads only, writes go through pywikibot
+        api = ApiClient(site, endpoint)
+        userinfo = UserInfo(api)
+        metadata = MetadataPrefetcher(api)
+        downloader = Downloader(session=api.session)
+        detect_file = DetectionClient(daemon, fallback=True) if daemon \
+            else detect
+
+        reported = 0
+        jobs = 0
         while True:
-            _, change = redis.blpop(REDIS_KEY)
-            change = json.loads(change)
-            filepage = pywikibot.FilePage(site, change['title'])
+            queue.done()
+            leases.release()
+            admission.release()
+
+            if max_jobs and jobs >= max_jobs or \
+                    max_rss and peak_rss() > max_rss:
+                pywikibot.output('Recycling after %d items, %s peak memory'
+                                 % (jobs, sizeof_fmt(peak_rss())))
+                return
+
+            if time.time() - reported > REPORT_INTERVAL:
+                queue.report()
+                api.report()
+                reported = time.time()
+
+            change = queue.pop()
+            if change is None:
+                continue
+            jobs += 1
 
-            if not filepage.exists():
+            if leases.acquire(change['title']) is None:
+                # Another worker is on this file, come back to it later
+                defer(queue, scheduler, change, LEASE_RETRY)
                 continue
 
+            if 'editcount' in change:
+                # Looked up by the watcher already
+                userinfo.seed(change['user'], change['editcount'])
+
+            # Look up what is queued next in the same batch
+            upcoming = queue.peek(BATCH_SIZE - 1)
+            userinfo.prefetch(item.get('user') for item in
+                              [change] + upcoming)
+            metadata.prefetch(item['title'] for item in [change] + upcoming)
+
+            timestamp = change.get('log_params', {}).get('img_timestamp')
+            if timestamp:
+                timestamp = pywikibot.Timestamp.fromtimestampformat(timestamp)
+
+            filepage = pywikibot.FilePage(site, change['title'])
+
             for i in range(8):
-                try:
-                    filepage.get_file_history()
-                except pywikibot.exceptions.PageRelatedError as e:
-                    # pywikibot.exceptions.PageRelatedError:
-                    # loadimageinfo: Query on ... returned no imageinfo
-                    pywikibot.exception(e)
-                    site.throttle(write=True)
-                else:
+                record = metadata.get(change['title'], timestamp, force=i > 0)
+                if record is None or not record.exists or record.imageinfo:
                     break
+
+                # Query on ... returned no imageinfo
+                pywikibot.warning('No imageinfo for %s on attempt %d' % (
+                    filepage, i))
+                site.throttle(write=True)
             else:
-                raise
+                raise pywikibot.PageRelatedError(
+                    filepage, 'Query on %s returned no imageinfo')
+
+            if record is None:
+                # Prefetch failed, leave it to pywikibot
+                if not filepage.exists():
+                    continue
+            elif not record.exists:
+                continue
+            else:
+                record.apply(filepage)
+
+                # Older revisions stay downloadable from the file history, so
+                # one is only skipped if its content is that of the latest
+                # revision or was scanned already
+                if timestamp and is_superseded(
+                        record, timestamp, redis, queue.key + ':scanned'):
+                    pywikibot.output('Skipping %s at %s, superseded by %s' % (
+                        change['title'], timestamp,
+                        record.latest_timestamp()))
+                    continue
 
             try:
                 revision = filepage.get_file_history()[
@@ -103,33 +212,43 @@ def run_worker():
                             'Cannot fetch specified revision, falling back to '
                             'latest revision.')
 
-            if pywikibot.User(site, revision.user).editCount(
-                    force=True) > 200:
+            if userinfo.is_experienced(revision.user):
+                continue
+
+            if not admission.fits(revision.size):
+                pywikibot.warning('Never enough disk space for %s (%s)' % (
+                    change['title'], sizeof_fmt(revision.size)))
+                continue
+
+            mode = admission.admit(revision.size)
+            if mode is None:
+                pywikibot.output('No room for %s (%s) now, deferring' % (
+                    change['title'], sizeof_fmt(revision.size)))
+                defer(queue, scheduler, change, ADMISSION_RETRY)
                 continue
 
             pywikibot.output('Working on: %s at %s' % (change['title'],
                                                        revision.timestamp))
 
             path = os.path.join(tmpdir, str(uuid.uuid1()))
+            f = path
 
             # Download
             try:
-                for i in range(8):
-                    try:
-                        success = filepage.download(path, revision=revision)
-                    except Exception as e:
-                        pywikibot.exception(e)
-                        success = False
-                    if success:
-                        break
-                    else:
-                        pywikibot.warning(
-                            'Possibly corrupted download on attempt %d' % i)
-                        site.throttle(write=True)
-                else:
-                    pywikibot.warning('FIXME: Download attempt exhausted')
-
-                res = detect(path)
+                success, f = download(downloader, revision, path,
+                                      mode == 'memory', cache)
+                if not success:
+                    pywikibot.warning('Download of %s failed' % filepage)
+                    continue
+
+                if not leases.renew():
+                    pywikibot.warning('Lost the lease on %s' % filepage)
+                    continue
+
+                # Enough to act on, the rest would not change what is done
+                res = detect_file(f, stop=True)
+                redis.hset(queue.key + ':scanned', revision.sha1,
+                           DETECTOR_VERSION)
                 if res:
                     msg = []
                     for item in res:
@@ -154,24 +273,140 @@ def run_worker():
                                      % filepage.title(asLink=True))
                     pywikibot.output(msg)
 
-                    execute_file(filepage, revision, msg, res, path)
+                    queue.record_hit(revision.user)
+
+                    # Fencing: someone else may have taken over the file while
+                    # detection ran
+                    if not leases.renew():
+                        pywikibot.warning('Lost the lease on %s, not acting '
+                                          'on it' % filepage)
+                        continue
+
+                    execute_file(filepage, revision, msg, res, f, scheduler)
 
             except Exception:
                 traceback.print_exc()
             finally:
-                os.remove(path)
+                if os.path.exists(path):
+                    os.remove(path)
 
         pywikibot.output("Exit - THIS SHOULD NOT HAPPEN")
     finally:
         shutil.rmtree(tmpdir)
 
 
-def execute_file(filepage, revision, msg, res, path):
+def supervise(children, lanes=LANES, max_jobs=MAX_JOBS, max_rss=MAX_RSS,
+              **kwargs):
+    # Forks the workers, after the detectors have been imported, and
+    # replaces them when they are done or crashed. Every child slot keeps
+    # its consumer name, so a replacement takes over the pending items of
+    # its predecessor.
+    slots = {}  # pid -> slot
+
+    def spawn(slot):
+        consumer = '%s:%s:%d' % (socket.gethostname(), '+'.join(lanes),
+                                 slot)
+        pid = os.fork()
+        if pid:
+            slots[pid] = slot
+            return
+
+        status = 1
+        try:
+            run_worker(lanes=lanes, consumer=consumer, max_jobs=max_jobs,
+                       max_rss=max_rss, **kwargs)
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                pywikibot.stopme()
+            finally:
+                os._exit(status)
+
+    for slot in range(children):
+        spawn(slot)
+
+    try:
+        while True:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            slot = slots.pop(pid, None)
+            if slot is None:
+                continue
+
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                pywikibot.output('Worker %d finished, replacing it' % slot)
+            else:
+                pywikibot.warning('Worker %d died with status %d, '
+                                  'restarting it' % (slot, status))
+                time.sleep(RESTART_DELAY)
+            spawn(slot)
+    finally:
+        for pid in slots:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+def defer(queue, scheduler, change, delay):
+    # Add the item again after a while, and only then let go of it, so a
+    # crash in between cannot lose it
+    stream = queue.origin()
+    if not scheduler.schedule(delay, 'requeue',
+                              pywikibot.FilePage(scheduler.site,
+                                                 change['title']),
+                              {'stream': stream, 'record': change}):
+        enqueue(queue.redis, stream, change)
+    queue.defer()
+
+
+def is_superseded(record, timestamp, redis, scanned_key):
+    infos = {pywikibot.Timestamp.fromISOformat(info['timestamp']): info
+             for info in record.imageinfo}
+    if timestamp not in infos or max(infos) <= timestamp:
+        return False
+
+    sha1 = infos[timestamp]['sha1']
+    return (sha1 == infos[max(infos)]['sha1'] or
+            redis.hget(scanned_key, sha1) == str(DETECTOR_VERSION))
+
+
+def download(downloader, revision, path, in_memory, cache):
+    if in_memory:
+        data = cache.read(revision.sha1)
+        if data is not None:
+            return True, MemoryFile(data)
+
+        buf = io.BytesIO()
+        success = downloader.fetch(revision.url, revision.sha1, buf,
+                                   revision.size)
+        f = MemoryFile(buf.getvalue())
+    else:
+        if cache.get(revision.sha1, path):
+            return True, path
+
+        with open(path, 'wb') as fout:
+            success = downloader.fetch(revision.url, revision.sha1, fout,
+                                       revision.size)
+        f = path
+
+    if success:
+        cache.put(revision.sha1, f)
+    return success, f
+
+
+def execute_file(filepage, revision, msg, res, f, scheduler):
     if all(item['posexact'] and
            item['mime'][0] == filepage.latest_file_info.mime and
            not item['middleware']
            for item in res):
-        overwrite(filepage, msg, res, path)
+        overwrite(filepage, msg, res, f)
         return
 
     if any((item['posexact'] or item['middleware']) and
@@ -183,9 +418,12 @@ def execute_file(filepage, revision, msg, res, path):
             delete(filepage, msg)
             protect(filepage, msg)
             for i in range(8):
-                threading.Timer((i+1)*8, delete, (filepage, msg)).start()
+                scheduler.schedule((i+1)*8, 'delete', filepage, msg)
+            # The protection expires after a minute, before the last
+            # re-deletion
+            scheduler.schedule(48, 'protect', filepage, msg)
         else:
-            overwrite(filepage, msg, res, path)
+            overwrite(filepage, msg, res, f)
             try:
                 revdel(filepage, revision, msg)
             except Exception:
@@ -216,6 +454,9 @@ def csd_g7_eligible(filepage, revision):
             return False
 
     # condition: unused
+    if getattr(filepage, '_globalusage', None) is not None:
+        return not filepage._globalusage
+
     req = filepage.site._simple_request(
         action='query',
         prop='globalusage',
@@ -248,26 +489,87 @@ def retry_apierror(f):
         raise
 
 
-def overwrite(filepage, msg, res, path):
+def overwrite(filepage, msg, res, f):
     filepage._file_revisions.clear()
 
     if not filepage.get_file_history():
         pywikibot.warning("Page doesn't exist, skipping upload.")
         return
 
+    length = res[0]['pos']
+    comment = MESSAGE_PREFIX+msg
+
+    if length >= CHUNKED_UPLOAD_THRESHOLD:
+        retry_apierror(
+            lambda:
+            upload_prefix(filepage, f, length, comment)
+        )
+        return
+
     with tempfile.NamedTemporaryFile() as tmp:
-        with open(path, 'rb') as old:
-            shutil.copyfileobj(old, tmp)
+        with SubFileProxy(open_file(f), 0, length) as old:
+            shutil.copyfileobj(old, tmp, UPLOAD_CHUNK_SIZE)
 
-        tmp.truncate(res[0]['pos'])
+        tmp.flush()
         retry_apierror(
             lambda:
             filepage.upload(tmp.name,
-                            comment=MESSAGE_PREFIX+msg,
+                            comment=comment,
                             ignore_warnings=True)
         )
 
 
+def upload_prefix(filepage, f, length, comment):
+    # Chunked upload straight out of the downloaded file, so the prefix is
+    # never copied. MediaWiki only accepts the chunks of a stash in order.
+    site = filepage.site
+    filename = filepage.title(withNamespace=False)
+    token = site.tokens['csrf']
+
+    filekey = None
+    with SubFileProxy(open_file(f), 0, length) as fin:
+        offset = 0
+        while offset < length:
+            chunk = fin.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                raise IOError('File is shorter than %d bytes' % length)
+
+            params = {}
+            if filekey:
+                params['filekey'] = filekey
+            req = site._simple_request(
+                action='upload',
+                stash=True,
+                filename=filename,
+                filesize=length,
+                offset=offset,
+                ignorewarnings=True,
+                token=token,
+                mime={'chunk': (chunk, ('application', 'octet-stream'),
+                                {'filename': filename})},
+                **params
+            )
+            data = req.submit()['upload']
+            filekey = data['filekey']
+            offset = int(data.get('offset', offset + len(chunk)))
+            # The server says where the next chunk starts, which need not
+            # be where this one ended
+            fin.seek(offset)
+
+    data = site._simple_request(
+        action='upload',
+        filename=filename,
+        filekey=filekey,
+        comment=comment,
+        ignorewarnings=True,
+        token=token
+    ).submit()['upload']
+    if data['result'] != 'Success':
+        raise pywikibot.Error('Chunked upload of %s failed: %s' % (
+            filepage, data))
+
+
+@register_action('delete')
 def delete(filepage, msg):
     for i in range(8):
         filepage._file_revisions.clear()
@@ -294,6 +596,7 @@ def delete(filepage, msg):
         pywikibot.warning('FIXME: Deletion attempt exhausted')
 
 
+@register_action('protect')
 def protect(filepage, msg):
     # Make sure this is not executed on a page that is already protected.
     # For newly uploaded files this is fine.
@@ -375,8 +678,42 @@ def add_speedy(filepage, msg):
 
 
 def main():
-    pywikibot.handleArgs()
-    run_worker()
+    spool_threshold = SPOOL_THRESHOLD
+    lanes = []
+    cache_size = CACHE_SIZE
+    endpoint = None
+    children = 0
+    max_jobs = MAX_JOBS
+    max_rss = MAX_RSS
+    daemon = None
+    for arg in pywikibot.handleArgs():
+        if arg.startswith('-spool:'):
+            spool_threshold = int(arg[len('-spool:'):])
+        elif arg.startswith('-lane:'):
+            lanes.append(arg[len('-lane:'):])
+        elif arg.startswith('-cache:'):
+            cache_size = int(arg[len('-cache:'):])
+        elif arg.startswith('-api:'):
+            # e.g. a local stand-in for benchmarking
+            endpoint = arg[len('-api:'):]
+        elif arg.startswith('-children:'):
+            children = int(arg[len('-children:'):])
+        elif arg.startswith('-maxjobs:'):
+            max_jobs = int(arg[len('-maxjobs:'):])
+        elif arg.startswith('-maxrss:'):
+            max_rss = int(arg[len('-maxrss:'):])
+        elif arg.startswith('-daemon:'):
+            # Socket of a detection daemon run by the same account, by
+            # default ~/.embeddeddata/detect.sock (see detection/daemon.py)
+            daemon = arg[len('-daemon:'):]
+
+    if children:
+        supervise(children, lanes or LANES, max_jobs, max_rss,
+                  spool_threshold=spool_threshold, cache_size=cache_size,
+                  endpoint=endpoint, daemon=daemon)
+    else:
+        run_worker(spool_threshold, lanes or LANES, cache_size, endpoint,
+                   daemon=daemon)
 
 
 if __name__ == "__main__":
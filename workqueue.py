@@ -0,0 +1,443 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+import collections
+import json
+import os
+import socket
+import time
+
+import pywikibot
+from redis.exceptions import ResponseError
+
+from config import REDIS_KEY
+
+DEFAULT_WIKI = 'commonswiki'
+
+# Uploads by accounts with earlier hits are looked at first, and so are
+# small images, which are cheap to check and the most common carrier.
+SUSPICIOUS_MIMES = ['image/jpeg', 'image/png', 'image/gif']
+CHEAP_SIZE = 1 << 24
+EXPENSIVE_SIZE = 1 << 28
+
+AGING = 120  # Seconds of waiting that are worth one band
+REPORT_INTERVAL = 300
+
+# Media classes with very different detector costs get their own queues.
+# Lanes listed in LANE_LIMITS may only have that many jobs running at once,
+# over all workers, so ffmpeg never takes every slot.
+LANES = ['image', 'av', 'document']
+LANE_LIMITS = {'av': 2}
+LANE_SLOT_TTL = 3600
+DOCUMENT_TYPES = ['pdf', 'vnd.djvu', 'djvu']
+# For records without imageinfo, which the watcher may not have got
+AV_EXTENSIONS = ['flac', 'mid', 'mp3', 'mpeg', 'mpg', 'oga', 'ogg', 'ogv',
+                 'opus', 'wav', 'webm']
+DOCUMENT_EXTENSIONS = ['djvu', 'pdf']
+
+GROUP = 'workers'
+STREAM_MAXLEN = 100000
+CLAIM_IDLE = 3 * 3600  # Longer than any item takes to process
+CLAIM_EVERY = 100  # items
+CLAIM_BATCH = 100
+MAX_DELIVERIES = 3
+
+# Move the head of the list the queue used to be into a stream, unless
+# someone else took it first
+MIGRATE = """
+if redis.call('LINDEX', KEYS[1], 0) ~= ARGV[1] then
+    return 0
+end
+redis.call('LPOP', KEYS[1])
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*', 'record', ARGV[1])
+return 1
+"""
+
+
+def queue_key(site):
+    # Commons keeps the original key, other wikis get one each
+    dbname = site.dbName()
+    if dbname == DEFAULT_WIKI:
+        return REDIS_KEY
+    return '%s:%s' % (REDIS_KEY, dbname)
+
+
+def suspicion(record, hits):
+    score = 0
+    if hits:
+        score += 2
+
+    editcount = record.get('editcount')
+    if editcount is not None:
+        if editcount < 10:
+            score += 1
+        elif editcount > 50:
+            score -= 1
+
+    imageinfo = record.get('imageinfo')
+    if imageinfo:
+        if imageinfo['mime'] in SUSPICIOUS_MIMES:
+            score += 1
+        if imageinfo['size'] < CHEAP_SIZE:
+            score += 1
+        elif imageinfo['size'] > EXPENSIVE_SIZE:
+            score -= 2
+
+    return score
+
+
+def lane_of(record):
+    mime = (record.get('imageinfo') or {}).get('mime')
+    if not mime:
+        ext = record.get('title', '').rpartition('.')[2].lower()
+        if ext in AV_EXTENSIONS:
+            return 'av'
+        elif ext in DOCUMENT_EXTENSIONS:
+            return 'document'
+        return 'image'
+
+    major, _, minor = mime.partition('/')
+    if major in ['audio', 'video'] or minor == 'ogg':
+        return 'av'
+    elif minor in DOCUMENT_TYPES:
+        return 'document'
+    return 'image'
+
+
+def enqueue(redis, key, record):
+    # redis may be a pipeline
+    redis.xadd(key, {'record': json.dumps(record)},
+               maxlen=STREAM_MAXLEN, approximate=True)
+
+
+def entry_time(entry_id):
+    return int(entry_id.split('-')[0]) / 1000.0
+
+
+class WorkQueue(object):
+    # A Redis stream per lane and priority band, consumed through one
+    # consumer group. Entries are acknowledged only when done; entries of
+    # consumers that died are claimed by others after CLAIM_IDLE.
+
+    def __init__(self, redis, key, lanes=LANES, aging=AGING,
+                 limits=LANE_LIMITS, consumer=None):
+        self.redis = redis
+        self.key = key
+        self.lanes = list(lanes)
+        self.aging = aging
+        self.limits = limits
+        self.consumer = consumer or '%s:%d' % (socket.gethostname(),
+                                               os.getpid())
+
+        self.band_names = ['high', 'normal', 'low']
+        self.hits_key = key + ':hits'
+
+        self.migrate_script = redis.register_script(MIGRATE)
+
+        self.current = None  # (lane, stream, entry_id, record, started)
+        self.backlog = collections.deque()  # (lane, stream, entry_id, data)
+        self.claimed = 0
+
+    def join(self):
+        # Only for consumers
+        self.migrate()
+
+        for lane in self.lanes:
+            for band in self.bands(lane):
+                try:
+                    self.redis.xgroup_create(band, GROUP, id='0',
+                                             mkstream=True)
+                except ResponseError as e:
+                    if 'BUSYGROUP' not in str(e):
+                        raise
+
+        # Whatever this consumer had not finished before a restart. Entries
+        # this consumer keeps crashing on are given up.
+        for lane in self.lanes:
+            for band in self.bands(lane):
+                res = self.redis.xreadgroup(GROUP, self.consumer, {band: '0'})
+                for stream, entries in res:
+                    if not entries:
+                        continue
+
+                    deliveries = {}
+                    for item in self.redis.xpending_range(
+                            band, GROUP, '-', '+', len(entries),
+                            consumername=self.consumer):
+                        deliveries[item['message_id']] = \
+                            item['times_delivered']
+
+                    for entry_id, data in entries:
+                        if deliveries.get(entry_id, 0) > MAX_DELIVERIES:
+                            self.drop(band, entry_id, deliveries[entry_id])
+                        else:
+                            self.backlog.append((lane, band, entry_id, data))
+        if self.backlog:
+            pywikibot.output('Resuming %d unfinished items' % len(
+                self.backlog))
+
+    def migrate(self):
+        # The key itself is still the list of older versions, and of anything
+        # else that pushes to it
+        moved = 0
+        while True:
+            item = self.redis.lindex(self.key, 0)
+            if item is None:
+                break
+
+            try:
+                record = json.loads(item)
+            except ValueError:
+                pywikibot.warning('Dropping unreadable %r' % item)
+                self.redis.lrem(self.key, 1, item)
+                continue
+
+            moved += self.migrate_script(
+                keys=[self.key, self.band(record, None)],
+                args=[item, STREAM_MAXLEN])
+        if moved:
+            pywikibot.output('Moved %d items from the old queue' % moved)
+
+    def lane_key(self, lane):
+        return '%s:%s' % (self.key, lane)
+
+    def bands(self, lane):
+        key = self.lane_key(lane)
+        return [key + ':high', key, key + ':low']
+
+    def streams(self, lanes):
+        ret = []
+        for lane in lanes:
+            ret += self.bands(lane)
+        return ret
+
+    def band(self, record, hits):
+        bands = self.bands(lane_of(record))
+        score = suspicion(record, hits)
+        if score >= 3:
+            return bands[0]
+        elif score <= -1:
+            return bands[2]
+        return bands[1]
+
+    def hits(self, users):
+        if not users:
+            return []
+        return self.redis.hmget(self.hits_key, users)
+
+    def record_hit(self, user):
+        self.redis.hincrby(self.hits_key, user, 1)
+
+    def acquire(self, lane):
+        # Take one of the lane's slots, shared by all workers. Slots of
+        # crashed workers expire.
+        if lane not in self.limits:
+            return True
+
+        key = self.lane_key(lane) + ':active'
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.execute_command('ZADD', key, now + LANE_SLOT_TTL, self.consumer)
+        pipe.zcard(key)
+        if pipe.execute()[-1] <= self.limits[lane]:
+            return True
+
+        self.release(lane)
+        return False
+
+    def release(self, lane):
+        if lane in self.limits:
+            self.redis.zrem(self.lane_key(lane) + ':active', self.consumer)
+
+    def heads(self, streams, count=1):
+        # The oldest entries not yet delivered to the group
+        pipe = self.redis.pipeline(transaction=False)
+        for stream in streams:
+            pipe.xinfo_groups(stream)
+        last_ids = []
+        for groups in pipe.execute():
+            last_ids += [group['last-delivered-id'] for group in groups
+                         if group['name'] == GROUP] or ['0-0']
+
+        pipe = self.redis.pipeline(transaction=False)
+        for stream, last_id in zip(streams, last_ids):
+            pipe.xrange(stream, min=last_id, count=count + 1)
+        return [[entry for entry in entries if entry[0] != last_id][:count]
+                for entries, last_id in zip(pipe.execute(), last_ids)]
+
+    def claim_stale(self):
+        for lane in self.lanes:
+            for band in self.bands(lane):
+                pending = self.redis.xpending_range(
+                    band, GROUP, '-', '+', CLAIM_BATCH)
+                for item in pending:
+                    if item['time_since_delivered'] < CLAIM_IDLE * 1000:
+                        continue
+                    if item['times_delivered'] > MAX_DELIVERIES:
+                        self.drop(band, item['message_id'],
+                                  item['times_delivered'])
+                        continue
+
+                    for entry_id, data in self.redis.xclaim(
+                            band, GROUP, self.consumer, CLAIM_IDLE * 1000,
+                            [item['message_id']]):
+                        self.backlog.append((lane, band, entry_id, data))
+
+    def drop(self, stream, entry_id, deliveries):
+        # Kills whoever takes it, give up
+        pywikibot.warning('Dropping %s after %d deliveries' % (
+            entry_id, deliveries))
+        self.redis.xack(stream, GROUP, entry_id)
+        self.redis.xdel(stream, entry_id)
+
+    def pop(self, timeout=5):
+        self.claimed += 1
+        if self.claimed % CLAIM_EVERY == 1:
+            self.migrate()
+            self.claim_stale()
+
+        for i in range(len(self.backlog)):
+            lane, stream, entry_id, data = self.backlog.popleft()
+            if self.acquire(lane):
+                return self.start(lane, stream, entry_id, data)
+            self.backlog.append((lane, stream, entry_id, data))
+
+        # A band is worth one band more for every `aging` seconds its oldest
+        # item has waited, so the low bands cannot starve.
+        lanes = list(self.lanes)
+        while lanes:
+            heads = iter(self.heads(self.streams(lanes)))
+
+            now = time.time()
+            best = None
+            for lane in lanes:
+                for i, band in enumerate(self.bands(lane)):
+                    head = next(heads)
+                    if not head:
+                        continue
+                    waited = now - entry_time(head[0][0])
+                    priority = i - waited / self.aging
+                    if best is None or priority < best[0]:
+                        best = priority, lane, band
+
+            if not best:
+                break
+
+            _, lane, band = best
+            if not self.acquire(lane):
+                lanes.remove(lane)
+                continue
+
+            res = self.redis.xreadgroup(GROUP, self.consumer, {band: '>'},
+                                        count=1)
+            for stream, entries in res:
+                for entry_id, data in entries:
+                    return self.start(lane, band, entry_id, data)
+            self.release(lane)
+
+        # Nothing available right now, wait for anything in a free lane
+        if not lanes:
+            time.sleep(timeout)
+            return None
+
+        key_lanes = {}
+        for lane in lanes:
+            for band in self.bands(lane):
+                key_lanes[band] = lane
+
+        res = self.redis.xreadgroup(
+            GROUP, self.consumer, {band: '>' for band in key_lanes},
+            count=1, block=int(timeout * 1000))
+        # Possibly one entry from each stream, they are ours now
+        for stream, entries in res or []:
+            for entry_id, data in entries:
+                self.backlog.append((key_lanes[stream], stream,
+                                     entry_id, data))
+        return None
+
+    def start(self, lane, stream, entry_id, data):
+        record = json.loads(data['record'])
+        record.setdefault('queued', entry_time(entry_id))
+        self.current = lane, stream, entry_id, record, time.time()
+        return record
+
+    def done(self):
+        if not self.current:
+            return
+
+        lane, stream, entry_id, record, started = self.current
+        self.current = None
+
+        now = time.time()
+        key = self.lane_key(lane) + ':latency'
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xack(stream, GROUP, entry_id)
+        pipe.xdel(stream, entry_id)
+        pipe.hincrby(key, 'count', 1)
+        pipe.hincrbyfloat(key, 'processing', now - started)
+        pipe.hincrbyfloat(key, 'total', now - record['queued'])
+        pipe.execute()
+
+        self.release(lane)
+
+    def origin(self):
+        # The stream the current item came from
+        return self.current[1]
+
+    def defer(self):
+        # Give up on the current item without counting it as done. It is up
+        # to the caller to have added it again before.
+        lane, stream, entry_id, record, started = self.current
+        self.current = None
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xack(stream, GROUP, entry_id)
+        pipe.xdel(stream, entry_id)
+        pipe.execute()
+
+        self.release(lane)
+
+    def peek(self, count):
+        ret = []
+        for entries in self.heads(self.streams(self.lanes), count):
+            ret += [json.loads(data['record']) for entry_id, data in entries]
+        return ret[:count]
+
+    def report(self):
+        pipe = self.redis.pipeline(transaction=False)
+        for lane in self.lanes:
+            for band in self.bands(lane):
+                pipe.xlen(band)
+                pipe.xpending(band, GROUP)
+            pipe.hgetall(self.lane_key(lane) + ':latency')
+        res = iter(pipe.execute())
+
+        for lane in self.lanes:
+            depths = []
+            for name in self.band_names:
+                length, pending = next(res), next(res)
+                depths.append('%s=%d (%d pending)' % (
+                    name, length, pending['pending']))
+            latency = next(res)
+            count = int(latency.get('count', 0)) or 1
+            pywikibot.output(
+                'Lane %s: %s; average %.1fs processing, '
+                '%.1fs since queued' % (
+                    lane, ', '.join(depths),
+                    float(latency.get('processing', 0)) / count,
+                    float(latency.get('total', 0)) / count))